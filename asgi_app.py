@@ -0,0 +1,950 @@
+# --- Virgo's Whisper AI: asyncio (ASGI) pipeline ---
+# The same /analyze-audio-file router as flask_app.py, but asyncio-native, so one
+# process can hold many in-flight radio clips without a blocked thread each.
+# Run with an ASGI server, e.g.:  hypercorn asgi_app:app --bind 0.0.0.0:8000
+#
+# Protocols, sessions, caches, logging and prompts are shared with flask_app.py.
+# Only the upstream calls differ: they go through pooled keep-alive HTTP
+# connections, and independent steps (LLM and TTS, log writes and TTS) overlap.
+
+# --- Imports ---
+import asyncio
+import json
+import logging
+import os
+import time
+
+import httpx
+import websockets
+from quart import Quart, request, websocket, jsonify, Response
+
+import flask_app as core
+
+# --- Setup ---
+app = Quart(__name__)
+logger = logging.getLogger("virgo.asgi") # Shares flask_app's handler and LOG_LEVEL
+app.config['MAX_CONTENT_LENGTH'] = core.MAX_UPLOAD_BYTES
+
+ASSEMBLYAI_BASE_URL = "https://api.assemblyai.com/v2"
+TRANSCRIBE_TIMEOUT_SECONDS = 60
+HTTP_POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.environ.get('HTTP_MAX_CONNECTIONS', 100)),
+    max_keepalive_connections=int(os.environ.get('HTTP_MAX_KEEPALIVE', 20)),
+    keepalive_expiry=60
+)
+
+# One pooled client per provider, opened when the server starts
+http_clients = []
+assemblyai_http = None
+cerebras_client = None
+elevenlabs_client = None
+
+# Keep references to fire-and-forget tasks so they aren't garbage collected mid-flight
+BACKGROUND_TASKS = set()
+
+def pooled_http_client(**kwargs):
+    client = httpx.AsyncClient(limits=HTTP_POOL_LIMITS, timeout=httpx.Timeout(30.0), **kwargs)
+    http_clients.append(client)
+    return client
+
+@app.before_serving
+async def open_clients():
+    global assemblyai_http, cerebras_client, elevenlabs_client
+    if core.PROVIDER_MODE == 'fake':
+        # Same pooled AssemblyAI client and polling code, answered by a local transport
+        assemblyai_http = pooled_http_client(base_url=ASSEMBLYAI_BASE_URL, transport=core.fake_providers.FakeAssemblyAITransport())
+        cerebras_client = core.fake_providers.FakeAsyncCerebras()
+        elevenlabs_client = core.fake_providers.FakeAsyncElevenLabs()
+        logger.warning("PROVIDER_MODE=fake: using local provider stand-ins.")
+        return
+    from cerebras.cloud.sdk import AsyncCerebras
+    from elevenlabs.client import AsyncElevenLabs
+    assemblyai_http = pooled_http_client(
+        base_url=ASSEMBLYAI_BASE_URL,
+        headers={"authorization": os.environ.get('ASSEMBLYAI_API_KEY', '')}
+    )
+    cerebras_client = AsyncCerebras(api_key=os.environ.get('CEREBRAS_API_KEY'), http_client=pooled_http_client())
+    elevenlabs_client = AsyncElevenLabs(api_key=os.environ.get('ELEVENLABS_API_KEY'), httpx_client=pooled_http_client())
+    logger.info("Async provider clients initialized.")
+
+@app.after_serving
+async def close_clients():
+    for client in http_clients:
+        await client.aclose()
+
+@app.after_request
+async def allow_cors(response):
+    response.headers['Access-Control-Allow-Origin'] = '*' # For web demo
+    return response
+
+def request_route():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+async def start_request_timing():
+    core.CURRENT_TIMINGS.set(core.RequestTimings())
+
+@app.after_request
+async def add_server_timing(response):
+    timings = core.CURRENT_TIMINGS.get()
+    if timings is None:
+        return response
+    response.headers['Server-Timing'] = timings.server_timing()
+    response.headers['X-Virgo-Branch'] = timings.branch
+    if not timings.streaming_body:
+        core.finish_request_timing(timings, request_route(), response.status_code)
+    return response
+
+async def wait_for_startup():
+    """flask_app.wait_for_startup, without blocking the event loop."""
+    if core.READINESS.settled(core.ROUTER_DEPENDENCIES):
+        return True
+    return await asyncio.to_thread(core.wait_for_startup)
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+# --- DEADLINES, HEDGING & CIRCUIT BREAKERS (async) ---
+
+async def guarded(guard, make_call, hedge=False):
+    """
+    Async twin of flask_app.ProviderGuard.call, sharing its breaker and latency
+    history. Here a hedged loser or a timed-out call is actually cancelled.
+    """
+    if not guard.allow():
+        raise core.ProviderUnavailable(f"{guard.name} is unavailable (circuit open)")
+    started = time.perf_counter()
+    deadline = started + guard.time_left()
+    hedge_delay = guard.hedge_delay() if hedge else None
+    hedge_at = started + hedge_delay if hedge_delay is not None else None
+    pending = {asyncio.ensure_future(make_call())}
+    error = None
+    try:
+        while pending:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            wake_at = min(deadline, hedge_at) if hedge_at else deadline
+            done, pending = await asyncio.wait(pending, timeout=wake_at - now, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    guard.record_success(time.perf_counter() - started)
+                    return task.result()
+                error = task.exception()
+            if pending and hedge_at and time.perf_counter() >= hedge_at:
+                logger.info(f"{guard.name} call passed its p{core.HEDGE_PERCENTILE} ({hedge_delay:.2f}s). Sending a hedged request.")
+                pending.add(asyncio.ensure_future(make_call()))
+                hedge_at = None
+        timed_out = bool(pending)
+    except asyncio.CancelledError:
+        guard.abandon()
+        raise
+    finally:
+        for task in pending:
+            task.cancel()
+    guard.record_miss(error, deadline - started)
+    if error is not None and not timed_out:
+        raise error
+    raise core.ProviderUnavailable(f"{guard.name} did not answer within {deadline - started:.1f}s")
+
+
+# --- ASSEMBLYAI (async REST) ---
+
+class TranscriptionError(Exception):
+    pass
+
+async def transcribe_audio(audio_bytes):
+    """
+    Uploads the clip and polls for the transcript over the pooled connection.
+    Polls start fast and back off, instead of the SDK's fixed 3-second interval.
+    """
+    upload = await assemblyai_http.post("/upload", content=audio_bytes)
+    upload.raise_for_status()
+    job = await assemblyai_http.post("/transcript", json={"audio_url": upload.json()['upload_url']})
+    job.raise_for_status()
+    job_id = job.json()['id']
+
+    deadline = time.time() + TRANSCRIBE_TIMEOUT_SECONDS
+    delay = 0.2
+    while time.time() < deadline:
+        await asyncio.sleep(delay)
+        poll = await assemblyai_http.get(f"/transcript/{job_id}")
+        poll.raise_for_status()
+        result = poll.json()
+        if result['status'] == 'completed':
+            return result.get('text') or ""
+        if result['status'] == 'error':
+            raise TranscriptionError(result.get('error'))
+        delay = min(delay * 1.5, 1.0)
+    raise TranscriptionError(f"Timed out after {TRANSCRIBE_TIMEOUT_SECONDS}s")
+
+
+# --- CEREBRAS (async) ---
+
+MODEL_ID = "llama3.1-8b"
+
+# Identical prompts in flight on this event loop, for single-flight (results are cached in core.LLM_CACHE)
+LLM_IN_FLIGHT = {}
+
+async def cached_completion(messages, temperature):
+    """Async twin of flask_app.cached_completion, sharing its result cache and counters."""
+    key = core.LLM_CACHE.make_key(MODEL_ID, temperature, messages)
+    cached = core.LLM_CACHE.lookup(key)
+    if cached is not None:
+        return cached
+    task = LLM_IN_FLIGHT.get(key)
+    if task is not None:
+        core.METRICS.count("virgo_llm_cache_requests_total", result="coalesced")
+    else:
+        core.METRICS.count("virgo_llm_cache_requests_total", result="miss")
+        task = asyncio.ensure_future(guarded(core.CEREBRAS_GUARD, lambda: cerebras_client.chat.completions.create(
+            model=MODEL_ID,
+            messages=messages,
+            temperature=temperature
+        ), hedge=True))
+        LLM_IN_FLIGHT[key] = task
+
+        def finished(task):
+            LLM_IN_FLIGHT.pop(key, None)
+            if not task.cancelled() and task.exception() is None:
+                core.LLM_CACHE.store(key, task.result())
+        task.add_done_callback(finished)
+    # Shielded, so one caller giving up doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+async def chat(messages, temperature, stage="llm", cache=True):
+    with core.timed(stage):
+        if cache:
+            chat_completion = await cached_completion(messages, temperature)
+        else:
+            chat_completion = await guarded(core.CEREBRAS_GUARD, lambda: cerebras_client.chat.completions.create(
+                model=MODEL_ID,
+                messages=messages,
+                temperature=temperature
+            ), hedge=True)
+    return chat_completion.choices[0].message.content
+
+async def summarize_text(text_to_summarize, prompt_template):
+    logger.debug(f"Sending to Cerebras (async) for SUMMARY/DEBRIEF: {text_to_summarize[:50]}...")
+    try:
+        return (await chat([
+            {"role": "system", "content": prompt_template},
+            {"role": "user", "content": text_to_summarize}
+        ], temperature=0.3, stage="llm_summary")).strip()
+    except Exception as e:
+        logger.error(f"Exception while calling Cerebras (async) for summary: {e}")
+        return None
+
+async def rolling_summary(rolling, events):
+    cached_summary, text_to_summarize, prompt_template = rolling.plan(events)
+    if cached_summary is not None:
+        return cached_summary
+    summary = await summarize_text(text_to_summarize, prompt_template)
+    if summary is None:
+        return rolling.fallback(events)
+    rolling.record(events, summary)
+    return summary
+
+async def analyze_for_stress(text_to_analyze, clean_text):
+    with core.timed("stress_local"):
+        local_result = core.score_stress_locally(text_to_analyze, clean_text)
+    if local_result:
+        return local_result
+    logger.debug(f"Sending to Cerebras (async) for SIMPLE STRESS analysis: {text_to_analyze}")
+    try:
+        analysis_json = core.parse_stress_reply(await chat([
+            {"role": "system", "content": core.STRESS_SYSTEM_PROMPT},
+            {"role": "user", "content": text_to_analyze}
+        ], temperature=0.1, stage="llm_stress"))
+        analysis_json['tier'] = "llm"
+        return analysis_json
+    except Exception as e:
+        return core.fallback_stress_check(text_to_analyze, clean_text, e)
+
+async def stream_conversation_turn(protocol, transcript, convo_doc, responder_id):
+    """
+    Async twin of flask_app.stream_conversation_turn: yields the reply
+    sentence by sentence and saves the turn once the stream ends.
+    """
+    messages, history = core.build_guidance_prompt(protocol, transcript, convo_doc)
+    logger.debug(f"Streaming from Cerebras (async) for CONVERSATION: {transcript}")
+    splitter = core.SentenceSplitter()
+    spoken = []
+    started = time.perf_counter()
+
+    async def open_stream():
+        # Opening the stream and its first chunk is what the deadline and hedging cover
+        chunks = await cerebras_client.chat.completions.create(
+            model=MODEL_ID,
+            messages=messages,
+            temperature=0.3,
+            stream=True
+        )
+        try:
+            return chunks, await chunks.__anext__()
+        except StopAsyncIteration:
+            return chunks, None
+
+    async def all_chunks(token_stream, first_chunk):
+        if first_chunk:
+            yield first_chunk
+        async for chunk in token_stream:
+            yield chunk
+
+    try:
+        token_stream, first_chunk = await guarded(core.CEREBRAS_GUARD, open_stream, hedge=True)
+        async for chunk in all_chunks(token_stream, first_chunk):
+            if not chunk.choices:
+                continue
+            for sentence in splitter.feed(chunk.choices[0].delta.content or ""):
+                if not spoken:
+                    core.record_stage("llm_first_sentence", time.perf_counter() - started)
+                spoken.append(sentence)
+                yield sentence
+        for sentence in splitter.flush():
+            if not spoken:
+                core.record_stage("llm_first_sentence", time.perf_counter() - started)
+            spoken.append(sentence)
+            yield sentence
+        core.record_stage("llm_stream", time.perf_counter() - started)
+    except Exception as e:
+        logger.error(f"Exception while streaming Cerebras (async) for conversation: {e}")
+        if not spoken:
+            yield core.fallback_conversation_turn(protocol, responder_id, convo_doc is None, history, transcript)
+            return
+
+    ai_response_text = " ".join(spoken)
+    if splitter.complete:
+        ai_response_text += f" {core.COMPLETE_TAG}"
+    core.finish_conversation_turn(protocol, responder_id, convo_doc is None, history, transcript, ai_response_text)
+
+
+# --- ELEVENLABS (async) ---
+
+async def synthesize_stream(text_to_speak):
+    """
+    Async twin of flask_app.stream_voice_audio: returns an async iterator of
+    MP3 chunks (first chunk already fetched), or None if synthesis failed.
+    """
+    cache_key = core.voice_cache_key(text_to_speak)
+    cached_audio = await asyncio.to_thread(core.TTS_CACHE.get, cache_key)
+    if cached_audio is not None:
+        async def cached():
+            yield cached_audio
+        return cached()
+
+    async def open_stream():
+        chunks = elevenlabs_client.text_to_speech.stream(
+            text=text_to_speak,
+            voice_id=core.VOICE_ID,
+            model_id=core.VOICE_MODEL_ID,
+            output_format=core.VOICE_OUTPUT_FORMAT
+        )
+        return chunks, await chunks.__anext__()
+
+    try:
+        with core.timed("tts_first_chunk"):
+            audio_stream, first_chunk = await guarded(core.ELEVENLABS_GUARD, open_stream, hedge=True)
+    except Exception as e:
+        logger.error(f"Error calling ElevenLabs (async): {e}")
+        return None
+
+    async def chunks():
+        received = [first_chunk]
+        yield first_chunk
+        try:
+            async for chunk in audio_stream:
+                received.append(chunk)
+                yield chunk
+        except Exception as e:
+            logger.error(f"Error while streaming ElevenLabs audio (async): {e}")
+            return
+        run_in_background(asyncio.to_thread(core.TTS_CACHE.put, cache_key, b"".join(received)))
+    return chunks()
+
+def wants_streamed_audio():
+    stream_arg = request.args.get('stream')
+    if stream_arg is None:
+        return core.STREAM_AUDIO
+    return stream_arg.lower() not in ('0', 'false', 'no')
+
+class Reply:
+    """
+    What the router decided, independent of transport: an audio stream,
+    text-only fallback, "no content", or an error. HTTP and WebSocket callers
+    each send it their own way.
+    """
+
+    def __init__(self, audio=None, error=None, status=200, text=None):
+        self.audio = audio   # Async iterator of MP3 chunks
+        self.error = error
+        self.status = status
+        self.text = text     # Set instead of audio when the voice couldn't be generated
+        self.unvoiced = None # The end of a pipelined reply that couldn't be voiced, set when its audio ends
+        self.forget_unvoiced = None # Trims the conversation to what was voiced, for transports that can't send text
+
+NO_CONTENT = Reply(status=204)
+
+def text_only_reply(text_to_speak):
+    logger.warning(f"Sending text-only reply: {text_to_speak}")
+    return Reply(text=text_to_speak)
+
+async def voice_reply(text_to_speak):
+    audio_chunks = await synthesize_stream(text_to_speak)
+    return Reply(audio=audio_chunks) if audio_chunks else text_only_reply(text_to_speak)
+
+async def voice_body_sentence(sentence):
+    """flask_app.voice_body_sentence: streamed audio, or a whole clip through its own guard."""
+    sentence_audio = await synthesize_stream(sentence)
+    if sentence_audio:
+        return sentence_audio
+    clip = await asyncio.to_thread(core.generate_voice_audio, sentence)
+    if not clip:
+        return None
+    async def whole_clip():
+        yield clip
+    return whole_clip()
+
+async def pipelined_voice_reply(sentences, responder_id=core.DEFAULT_RESPONDER_ID):
+    """
+    Speaks each sentence as soon as it is ready; the LLM keeps generating in
+    its own task while earlier sentences are synthesized and sent. Once the
+    audio has started, each sentence gets the TTS timeout of its own.
+    """
+    sentence_queue = asyncio.Queue()
+    timings = core.CURRENT_TIMINGS.get()
+
+    async def produce():
+        try:
+            async for sentence in sentences:
+                await sentence_queue.put(sentence)
+        except Exception as e:
+            logger.error(f"Error while generating sentences: {e}")
+        finally:
+            await sentence_queue.put(None) # End of the reply
+
+    run_in_background(produce())
+
+    first_sentence = await sentence_queue.get()
+    first_audio = await synthesize_stream(first_sentence) if first_sentence else None
+    if not first_audio:
+        # No voice: wait for the rest of the reply and send it as text
+        sentences = []
+        if first_sentence:
+            sentences.append(first_sentence)
+            while (sentence := await sentence_queue.get()) is not None:
+                sentences.append(sentence)
+        return text_only_reply(" ".join(sentences) or core.CONNECTION_TROUBLE)
+
+    reply = Reply()
+
+    async def audio_chunks():
+        if timings is not None:
+            timings.in_body = True
+        async for chunk in first_audio:
+            yield chunk
+        voiced = [first_sentence]
+        while (sentence := await sentence_queue.get()) is not None:
+            sentence_audio = await voice_body_sentence(sentence)
+            if not sentence_audio:
+                break
+            async for chunk in sentence_audio:
+                yield chunk
+            voiced.append(sentence)
+        if sentence is None:
+            return
+        # The rest goes out as text where the transport can carry it (see
+        # send_reply_over_websocket and spoken_cut_off)
+        unvoiced = [sentence]
+        while (sentence := await sentence_queue.get()) is not None:
+            unvoiced.append(sentence)
+        logger.error(f"Could not voice the rest of the reply: {' '.join(unvoiced)}")
+        reply.unvoiced = " ".join(unvoiced)
+        reply.forget_unvoiced = lambda: core.keep_only_voiced(responder_id, " ".join(voiced))
+    reply.audio = audio_chunks()
+    return reply
+
+async def conversation_turn_reply(protocol, transcript, convo_doc, responder_id, pipelined=True, speculation=None):
+    opening = core.opening_turn(protocol, transcript, responder_id) if convo_doc is None else None
+    if opening:
+        core.set_branch("protocol_opening")
+        if speculation:
+            speculation.cancel()
+        return await voice_reply(opening)
+    if speculation and speculation.matches(protocol, transcript):
+        logger.info("Using the reply speculated from the partial transcript.")
+        return await voice_reply(await speculation.commit())
+    if speculation:
+        speculation.cancel()
+    if core.PIPELINE_GUIDANCE and pipelined:
+        return await pipelined_voice_reply(stream_conversation_turn(protocol, transcript, convo_doc, responder_id), responder_id)
+    sentences = [sentence async for sentence in stream_conversation_turn(protocol, transcript, convo_doc, responder_id)]
+    return await voice_reply(" ".join(sentences))
+
+def timed_body(audio_chunks):
+    """Times the request when its streamed body finishes, not when the headers go out."""
+    timings = core.CURRENT_TIMINGS.get()
+    if timings is None:
+        return audio_chunks
+    timings.streaming_body = True
+    route = request_route()
+
+    async def body():
+        try:
+            async for chunk in audio_chunks:
+                yield chunk
+        finally:
+            core.finish_request_timing(timings, route, 200)
+    return body()
+
+async def spoken_cut_off(reply):
+    """
+    An HTTP audio body can't carry the unvoiced end of a reply as text: say
+    that it was cut off instead, and remember only what was heard.
+    """
+    async for chunk in reply.audio:
+        yield chunk
+    if reply.unvoiced:
+        await asyncio.to_thread(reply.forget_unvoiced)
+        notice = await synthesize_stream(core.REPLY_CUT_OFF)
+        if notice:
+            async for chunk in notice:
+                yield chunk
+
+async def to_http_response(reply):
+    if reply.error:
+        return jsonify({"error": reply.error}), reply.status
+    if reply.status == 204:
+        return "OK", 204 # 204 means "No Content"
+    if reply.text is not None:
+        return jsonify({"text": reply.text, "fallback": "text_only"})
+    if wants_streamed_audio():
+        return Response(timed_body(spoken_cut_off(reply)), mimetype="audio/mpeg")
+    return Response(b"".join([chunk async for chunk in spoken_cut_off(reply)]), mimetype="audio/mpeg")
+
+
+# --- MAIN API ENDPOINT (The "Router") ---
+
+async def resolve_protocol_route(clean_text, responder_id):
+    """
+    The protocol this transcript belongs to, if any: the responder's active
+    conversation, or else a new trigger. Returns (protocol, convo_doc).
+    Usually in-memory, so it can run on every partial transcript; until
+    recovery finishes the conversation may be read from Firestore, so that
+    lookup runs off the event loop.
+    """
+    active_convo_doc = await asyncio.to_thread(core.get_active_conversation, responder_id)
+    if active_convo_doc:
+        protocol = core.find_protocol(active_convo_doc.to_dict().get('protocol_id'))
+        if protocol:
+            return protocol, active_convo_doc
+        logger.warning(f"Active convo for {responder_id} has a missing protocol ID. Treating as new.")
+    if any(command in clean_text for command in ("virgo take a note", "virgo summarize", "virgo debrief me")):
+        return None, None
+    return core.check_for_protocol_trigger(clean_text), None
+
+async def route_transcript(transcript_text, responder_id, source_name, pipelined=True, speculation=None):
+    """
+    Decides and produces the reply for one finished transcript.
+    """
+    clean_text = core.normalize_transcript(transcript_text)
+
+    # "Over and out" is the master override
+    if "over and out" in clean_text:
+        logger.info("'Over and out' detected. Ending conversation.")
+        core.set_branch("sign_off")
+        if await asyncio.to_thread(core.get_active_conversation, responder_id):
+            core.update_conversation_state(responder_id, {"state": "complete"})
+        return await voice_reply(core.SIGN_OFF)
+
+    protocol, convo_doc = await resolve_protocol_route(clean_text, responder_id)
+    if protocol:
+        core.set_branch("protocol_turn")
+        return await conversation_turn_reply(protocol, transcript_text, convo_doc, responder_id, pipelined, speculation)
+
+    ai_response_text = None
+    if "virgo take a note" in clean_text:
+        logger.info("Command detected: 'virgo take a note'")
+        core.set_branch("note")
+        try:
+            note = transcript_text.lower().split("take a note", 1)[1].strip()
+        except IndexError:
+            note = ""
+        if note:
+            log_data = { 'text': note, 'original_command': transcript_text, 'timestamp': time.time(), 'type': 'manual_log' }
+            # Queue the log write while the confirmation is synthesized
+            _, reply = await asyncio.gather(asyncio.to_thread(core.log_event, log_data), voice_reply(f"Note taken: {note}"))
+            return reply
+        ai_response_text = core.NOTE_NOT_CAUGHT
+
+    elif "virgo summarize" in clean_text:
+        logger.info("Command detected: 'virgo summarize'")
+        core.set_branch("summarize")
+        recent_comms = await asyncio.to_thread(core.latest_events, ['general_comm'], 10)
+        ai_response_text = await rolling_summary(core.COMMS_SUMMARY, recent_comms) if recent_comms else core.NO_RECENT_COMMS
+
+    elif "virgo debrief me" in clean_text:
+        logger.info("Command detected: 'virgo debrief me'")
+        core.set_branch("debrief")
+        critical_events = await asyncio.to_thread(core.latest_events, core.DEBRIEF_EVENT_TYPES, 20)
+        ai_response_text = await rolling_summary(core.DEBRIEF_SUMMARY, critical_events) if critical_events else core.NO_DEBRIEF_EVENTS
+
+    if ai_response_text:
+        logger.info(f"CONVERSATIONAL RESPONSE: {ai_response_text}")
+        return await voice_reply(ai_response_text)
+
+    # No convo, no trigger. Do a simple stress check.
+    logger.info("No conversation or trigger. Running simple stress check.")
+    core.set_branch("stress_only")
+    analysis_result = await analyze_for_stress(transcript_text, clean_text)
+    log_data = { 'text': transcript_text, 'original_filename': source_name, 'timestamp': time.time(), 'type': 'general_comm', 'cerebras_analysis': analysis_result }
+
+    if analysis_result.get("is_stressed") == True:
+        log_data['type'] = 'stress_detected'
+        # Log the stress event while the reminder is synthesized
+        _, reply = await asyncio.gather(asyncio.to_thread(core.log_event, log_data), voice_reply(core.STRESS_REMINDER))
+        return reply
+    await asyncio.to_thread(core.log_event, log_data) # Log the general_comm event
+    return NO_CONTENT
+
+@app.route('/metrics')
+async def metrics():
+    return Response(core.METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/')
+async def home():
+    return f"Virgo's Whisper AI (v3.9, async) is online. {len(core.PROTOCOLS.current.protocols)} protocols loaded (version {core.PROTOCOLS.current.number})."
+
+@app.route('/ready')
+async def ready():
+    report = core.READINESS.report()
+    status = 200 if core.READINESS.is_ready(core.ROUTER_DEPENDENCIES) else 503
+    return jsonify({"ready": status == 200, "dependencies": report,
+                    "protocol_version": core.PROTOCOLS.current.number}), status
+
+@app.route('/reload-protocols', methods=['POST'])
+async def reload_protocols():
+    await asyncio.to_thread(core.load_protocols_from_firebase)
+    return f"Reloaded. {len(core.PROTOCOLS.current.protocols)} protocols now loaded (version {core.PROTOCOLS.current.number})."
+
+@app.route('/analyze-audio-file', methods=['POST'])
+async def analyze_audio_file():
+    logger.info("Received a request on /analyze-audio-file (async)...")
+    if not await wait_for_startup():
+        return jsonify({"error": "Server is still starting up"}), 503
+    files = await request.files
+    form = await request.form
+    if 'audio_file' not in files:
+        return jsonify({"error": "No 'audio_file' key in request"}), 400
+
+    audio_file = files['audio_file']
+    if audio_file.filename == '':
+        return jsonify({"error": "No file selected"}), 400
+
+    responder_id = form.get('responder_id') or request.args.get('responder_id') or core.DEFAULT_RESPONDER_ID
+    if not core.RESPONDER_ID_PATTERN.match(responder_id):
+        return jsonify({"error": "Invalid 'responder_id'"}), 400
+
+    # 1. Read into memory, trim silence and transcribe
+    audio_bytes = core.read_upload(audio_file)
+    if audio_bytes is None:
+        return jsonify({"error": f"Audio file is larger than {core.MAX_UPLOAD_BYTES} bytes"}), 413
+    with core.timed("vad"):
+        audio_bytes, has_speech = core.prepare_audio(audio_bytes)
+    if not has_speech:
+        core.set_branch("no_speech")
+        return jsonify({"error": "No speech detected"}), 422
+    try:
+        with core.timed("transcribe"):
+            transcript_text = await transcribe_audio(audio_bytes)
+    except TranscriptionError as e:
+        return jsonify({"error": f"AssemblyAI Error: {e}"}), 500
+    except Exception as e:
+        return jsonify({"error": f"Server error: {e}"}), 500
+    if not transcript_text:
+        return jsonify({"error": "Transcription returned no text"}), 500
+
+    # 2. CONVERSATION ROUTING
+    try:
+        reply = await route_transcript(transcript_text, responder_id, audio_file.filename, pipelined=wants_streamed_audio())
+        return await to_http_response(reply)
+    except Exception as e:
+        logger.exception(f"Error in main analysis loop (async): {e}")
+        return jsonify({"error": f"Server error: {e}"}), 500
+
+
+# --- (NEW) v3.9: REAL-TIME STREAMING TRANSCRIPTION ---
+# The client streams 16-bit mono PCM frames over a WebSocket while the officer
+# is still talking. Partial transcripts are checked for "over and out" and
+# protocol triggers as they arrive, so routing (and a speculative LLM call)
+# starts before the end of speech.
+#
+# WebSocket protocol (/stream-audio?responder_id=...&sample_rate=16000):
+#   client -> server: binary PCM frames, then {"type": "end"}
+#   server -> client: {"type": "partial"|"final", "text": ...}, {"type": "route", ...},
+#                     binary MP3 frames, then {"type": "text", ...} with any part of
+#                     the reply that couldn't be voiced, then {"type": "audio_end"},
+#                     or {"type": "no_content"} / {"type": "error", "error": ...}
+
+class TranscriptEvent:
+    def __init__(self, text, is_final):
+        self.text = text
+        self.is_final = is_final
+
+class AssemblyAIStreamingBackend:
+    """AssemblyAI's real-time (v3) streaming speech-to-text over a WebSocket."""
+
+    URL = "wss://streaming.assemblyai.com/v3/ws"
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self._ws = None
+
+    async def start(self):
+        self._ws = await websockets.connect(
+            f"{self.URL}?sample_rate={self.sample_rate}&encoding=pcm_s16le",
+            additional_headers={"Authorization": os.environ.get('ASSEMBLYAI_API_KEY', '')}
+        )
+
+    async def send_audio(self, pcm_frame):
+        await self._ws.send(pcm_frame)
+
+    async def finish(self):
+        await self._ws.send(json.dumps({"type": "Terminate"}))
+
+    async def events(self):
+        async for message in self._ws:
+            data = json.loads(message)
+            if data.get('type') == 'Turn':
+                yield TranscriptEvent(data.get('transcript', ''), bool(data.get('end_of_turn')))
+            elif data.get('type') == 'Termination':
+                break
+
+    async def close(self):
+        await self._ws.close()
+
+class FakeStreamingBackend:
+    """
+    Local stand-in for development and tests: every audio frame is read as
+    UTF-8 words, each frame produces a partial, and finish() produces the final.
+    """
+
+    def __init__(self, sample_rate):
+        self._words = []
+        self._events = asyncio.Queue()
+
+    async def start(self):
+        pass
+
+    async def send_audio(self, pcm_frame):
+        self._words.extend(pcm_frame.decode('utf-8', errors='ignore').split())
+        await self._events.put(TranscriptEvent(" ".join(self._words), False))
+
+    async def finish(self):
+        await self._events.put(TranscriptEvent(" ".join(self._words), True))
+        await self._events.put(None)
+
+    async def events(self):
+        while True:
+            event = await self._events.get()
+            if event is None:
+                break
+            yield event
+
+    async def close(self):
+        pass
+
+STREAMING_BACKENDS = {
+    "assemblyai": AssemblyAIStreamingBackend,
+    "fake": FakeStreamingBackend,
+}
+STREAMING_STT_BACKEND = os.environ.get('STREAMING_STT_BACKEND', 'assemblyai')
+SPECULATE_AFTER_SECONDS = float(os.environ.get('SPECULATE_AFTER_SECONDS', 0.3))
+MAX_SPECULATIONS_PER_UTTERANCE = 3
+
+class SpeculativeTurn:
+    """
+    A protocol reply generated from a partial transcript. It is only used
+    (and only saved to the conversation) if the final transcript matches.
+    """
+
+    def __init__(self, protocol, transcript, convo_doc, responder_id):
+        self.protocol = protocol
+        self.transcript = transcript
+        self.clean_text = core.normalize_transcript(transcript)
+        self.convo_doc = convo_doc
+        self.responder_id = responder_id
+        messages, self.history = core.build_guidance_prompt(protocol, transcript, convo_doc)
+        core.restart_budget() # The reply starts here, however long the responder has been talking
+        # Uncached: the prompt carries this responder's conversation, and cancelling should stop the call
+        self.task = run_in_background(chat(messages, temperature=0.3, stage="llm_speculative", cache=False))
+
+    def matches(self, protocol, transcript):
+        return protocol.get('id') == self.protocol.get('id') and core.normalize_transcript(transcript) == self.clean_text
+
+    async def commit(self):
+        try:
+            ai_response_text = (await self.task).strip()
+        except Exception as e:
+            logger.error(f"Exception in speculative Cerebras call: {e}")
+            return core.fallback_conversation_turn(self.protocol, self.responder_id, self.convo_doc is None,
+                                                   self.history, self.transcript)
+        return core.finish_conversation_turn(self.protocol, self.responder_id, self.convo_doc is None,
+                                             self.history, self.transcript, ai_response_text)
+
+    def cancel(self):
+        self.task.cancel()
+
+class PartialSpotter:
+    """
+    Watches partial transcripts. Once a partial has stopped changing for
+    SPECULATE_AFTER_SECONDS and routes to a protocol, it starts the LLM call
+    for it in the background.
+    """
+
+    def __init__(self, responder_id):
+        self.responder_id = responder_id
+        self.speculation = None
+        self.speculations = 0
+        self._debounce = None
+
+    async def on_partial(self, transcript):
+        """Returns "over_and_out", a routed protocol, or None."""
+        clean_text = core.normalize_transcript(transcript)
+        if "over and out" in clean_text:
+            return "over_and_out"
+        protocol, convo_doc = await resolve_protocol_route(clean_text, self.responder_id)
+        if self._debounce:
+            self._debounce.cancel()
+        # A new protocol with a precomputed opening has nothing to speculate on
+        if convo_doc is None and protocol and core.OPENING_LINES.lookup(protocol, clean_text):
+            return protocol
+        if protocol and self.speculations < MAX_SPECULATIONS_PER_UTTERANCE:
+            self._debounce = run_in_background(self._speculate_later(protocol, transcript, convo_doc))
+        return protocol
+
+    async def _speculate_later(self, protocol, transcript, convo_doc):
+        await asyncio.sleep(SPECULATE_AFTER_SECONDS)
+        if self.speculation and self.speculation.matches(protocol, transcript):
+            return
+        if self.speculation:
+            self.speculation.cancel()
+        logger.info(f"Speculating protocol reply for partial: {transcript}")
+        self.speculation = SpeculativeTurn(protocol, transcript, convo_doc, self.responder_id)
+        self.speculations += 1
+
+    def close(self):
+        if self._debounce:
+            self._debounce.cancel()
+
+@app.websocket('/stream-audio')
+async def stream_audio():
+    timings = core.RequestTimings()
+    core.CURRENT_TIMINGS.set(timings)
+    try:
+        await handle_audio_stream()
+    finally:
+        core.finish_request_timing(timings, '/stream-audio', "ws")
+
+async def handle_audio_stream():
+    responder_id = websocket.args.get('responder_id') or core.DEFAULT_RESPONDER_ID
+    if not core.RESPONDER_ID_PATTERN.match(responder_id):
+        await websocket.send_json({"type": "error", "error": "Invalid 'responder_id'"})
+        return
+    sample_rate = websocket.args.get('sample_rate', '16000')
+    if not sample_rate.isdigit() or not 8000 <= int(sample_rate) <= 192000:
+        await websocket.send_json({"type": "error", "error": "Invalid 'sample_rate'"})
+        return
+    sample_rate = int(sample_rate)
+    if not await wait_for_startup():
+        await websocket.send_json({"type": "error", "error": "Server is still starting up"})
+        return
+
+    backend = STREAMING_BACKENDS[STREAMING_STT_BACKEND](sample_rate)
+    try:
+        await backend.start()
+    except Exception as e:
+        await websocket.send_json({"type": "error", "error": f"Streaming STT error: {e}"})
+        return
+
+    spotter = PartialSpotter(responder_id)
+
+    heard_speech = False
+
+    async def pump_audio():
+        nonlocal heard_speech
+        while True:
+            message = await websocket.receive()
+            if isinstance(message, bytes):
+                # Don't forward the silence before the officer starts talking
+                heard_speech = heard_speech or core.pcm16_frame_is_voiced(message)
+                if heard_speech:
+                    await backend.send_audio(message)
+            elif json.loads(message).get('type') == 'end':
+                await backend.finish()
+                return
+
+    pump = run_in_background(pump_audio())
+    final_parts = []
+    pending_partial = ""
+    routed = None
+    try:
+        async for event in backend.events():
+            if event.is_final:
+                final_parts.append(event.text)
+                pending_partial = ""
+                continue
+            pending_partial = event.text
+            transcript = " ".join(final_parts + [event.text])
+            await websocket.send_json({"type": "partial", "text": transcript})
+            route = await spotter.on_partial(transcript)
+            if route == "over_and_out":
+                break # No need to hear the rest of the clip
+            if route and route is not routed:
+                routed = route
+                await websocket.send_json({"type": "route", "protocol": route.get('name')})
+    except Exception as e:
+        await websocket.send_json({"type": "error", "error": f"Streaming STT error: {e}"})
+        return
+    finally:
+        pump.cancel()
+        spotter.close()
+        await backend.close()
+
+    # A turn the backend never finalized still counts
+    transcript_text = " ".join(part for part in final_parts + [pending_partial] if part).strip()
+    if not heard_speech and not transcript_text:
+        await websocket.send_json({"type": "error", "error": "No speech detected"})
+        return
+    await websocket.send_json({"type": "final", "text": transcript_text})
+    # The socket opened when the responder started talking: the deadline covers the reply, not the speech
+    core.restart_budget()
+    if not transcript_text:
+        await websocket.send_json({"type": "error", "error": "Transcription returned no text"})
+        return
+
+    try:
+        reply = await route_transcript(transcript_text, responder_id, "stream", speculation=spotter.speculation)
+    except Exception as e:
+        logger.error(f"Error in streaming analysis loop: {e}")
+        reply = Reply(error=f"Server error: {e}", status=500)
+    await send_reply_over_websocket(reply)
+
+async def send_reply_over_websocket(reply):
+    if reply.error:
+        await websocket.send_json({"type": "error", "error": reply.error})
+    elif reply.status == 204:
+        await websocket.send_json({"type": "no_content"})
+    elif reply.text is not None:
+        await websocket.send_json({"type": "text", "text": reply.text})
+    else:
+        async for chunk in reply.audio:
+            await websocket.send(chunk)
+        if reply.unvoiced:
+            # Never drop an instruction silently: the client speaks it after the audio
+            await websocket.send_json({"type": "text", "text": reply.unvoiced})
+        await websocket.send_json({"type": "audio_end"})
@@ -0,0 +1,275 @@
+# --- Virgo's Whisper AI: offline benchmark & load test ---
+# Replays a corpus of radio clips through /analyze-audio-file from many
+# simulated responders at once, and reports throughput and p50/p95/p99 latency
+# for each concurrency level and each router branch. Results are grouped by the
+# branch the server reports taking (X-Virgo-Branch), and any clip that took a
+# different branch than its corpus entry declares is flagged.
+#
+# By default it starts flask_app.py in-process on the fake providers
+# (PROVIDER_MODE=fake, see fake_providers.py), so no accounts are needed:
+#   python benchmark.py --concurrency 1,4,16 --rounds 3
+#   python benchmark.py --router-only            # zero provider latency: just our own overhead
+#   python benchmark.py --save baseline.json     # later: --compare baseline.json
+# Or point it at any running server, e.g. the asyncio app:
+#   PROVIDER_MODE=fake hypercorn asgi_app:app --bind 127.0.0.1:8000
+#   python benchmark.py --url http://127.0.0.1:8000
+
+# --- Imports ---
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+# One responder's shift: every routing branch, in an order that opens and closes a protocol.
+# A protocol's first clip is answered from its precomputed opening line, if it has one.
+# "transcript" clips are synthesized for the fake speech-to-text; "audio" entries send a real file.
+DEFAULT_CORPUS = [
+    {"branch": "stress_only", "transcript": "10-4, en route to the scene."},
+    {"branch": "stress_only", "transcript": "Send an ambulance to fifth and pine."},
+    {"branch": "protocol_opening", "transcript": "Shots fired, I'm hit!"},
+    {"branch": "protocol_turn", "transcript": "It's my left leg."},
+    {"branch": "protocol_turn", "transcript": "Pressure is on, EMS is here."},
+    {"branch": "note", "transcript": "Virgo, take a note. Suspect vehicle is a blue sedan."},
+    {"branch": "summarize", "transcript": "Virgo, summarize."},
+    {"branch": "debrief", "transcript": "Virgo, debrief me."},
+    {"branch": "stress_only", "transcript": "HELP! Help! I need backup NOW!"},
+    {"branch": "protocol_opening", "transcript": "We have a car crash on route nine."},
+    {"branch": "sign_off", "transcript": "Over and out."},
+    {"branch": "no_speech", "transcript": ""},
+]
+
+
+# --- CORPUS ---
+
+def load_corpus(path):
+    """A JSON-lines file of {"branch", "transcript"} or {"branch", "audio": "clip.wav"} entries."""
+    if not path:
+        return DEFAULT_CORPUS
+    corpus = []
+    with open(path) as corpus_file:
+        for line in corpus_file:
+            if line.strip():
+                corpus.append(json.loads(line))
+    return corpus
+
+def clip_label(entry):
+    """How a clip is named in mismatch reports."""
+    return entry.get('audio') or repr(entry.get('transcript', ''))
+
+def clip_bytes(entry, corpus_dir):
+    if 'audio' in entry:
+        with open(os.path.join(corpus_dir, entry['audio']), 'rb') as audio_file:
+            return entry['audio'], audio_file.read()
+    import fake_providers
+    return "clip.wav", fake_providers.encode_spoken_text(entry.get('transcript', ''))
+
+def multipart_body(fields, file_field, filename, file_bytes):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode() + file_bytes + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+# --- LOAD GENERATION ---
+
+class Sample:
+    def __init__(self, expected_branch, label, branch, status, seconds, first_byte_seconds):
+        self.expected_branch = expected_branch # What the corpus entry declares
+        self.label = label
+        self.branch = branch # What the server reports it took
+        self.status = status
+        self.seconds = seconds
+        self.first_byte_seconds = first_byte_seconds
+
+    @property
+    def failed(self):
+        return self.status is None or self.status >= 500
+
+    @property
+    def mismatched(self):
+        return not self.failed and self.branch != self.expected_branch
+
+def send_clip(url, responder_id, filename, audio_bytes, timeout):
+    """Posts one clip. Returns (status, branch taken, seconds to first body byte, seconds to last byte)."""
+    body, content_type = multipart_body({"responder_id": responder_id}, "audio_file", filename, audio_bytes)
+    http_request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout) as response:
+            response.read(1)
+            first_byte = time.perf_counter() - start
+            response.read()
+            return response.status, response.headers.get('X-Virgo-Branch', "unknown"), first_byte, time.perf_counter() - start
+    except urllib.error.HTTPError as e:
+        e.read()
+        elapsed = time.perf_counter() - start
+        return e.code, e.headers.get('X-Virgo-Branch', "unknown"), elapsed, elapsed
+    except Exception:
+        elapsed = time.perf_counter() - start
+        return None, "unknown", elapsed, elapsed
+
+def run_level(url, clips, concurrency, rounds, timeout):
+    """`concurrency` responders each replay the corpus `rounds` times. Returns (samples, wall seconds)."""
+    samples = []
+    lock = threading.Lock()
+    run_id = uuid.uuid4().hex[:6]
+
+    def responder(index):
+        responder_id = f"bench-{run_id}-{index}"
+        for _ in range(rounds):
+            for expected_branch, label, filename, audio_bytes in clips:
+                status, branch, first_byte, seconds = send_clip(url, responder_id, filename, audio_bytes, timeout)
+                with lock:
+                    samples.append(Sample(expected_branch, label, branch, status, seconds, first_byte))
+
+    threads = [threading.Thread(target=responder, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+# --- REPORTING ---
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def summarize(samples, wall_seconds=None):
+    latencies = [sample.seconds * 1000 for sample in samples]
+    summary = {
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if sample.failed),
+        "mismatches": sum(1 for sample in samples if sample.mismatched),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "first_byte_p50_ms": percentile([sample.first_byte_seconds * 1000 for sample in samples], 50),
+    }
+    if wall_seconds:
+        summary["throughput_rps"] = len(samples) / wall_seconds
+    return summary
+
+def report_level(concurrency, samples, wall_seconds):
+    summary = summarize(samples, wall_seconds)
+    print(f"\nconcurrency={concurrency}: {summary['requests']} requests, {summary['errors']} errors, "
+          f"{summary['mismatches']} branch mismatches, "
+          f"{summary['throughput_rps']:.1f} req/s")
+    print(f"  {'branch':<18}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttfb p50':>10}")
+    branches = {}
+    for branch in sorted({sample.branch for sample in samples}):
+        branch_summary = summarize([sample for sample in samples if sample.branch == branch])
+        branches[branch] = branch_summary
+        print_row(branch, branch_summary)
+    print_row("ALL", summary)
+    summary["branches"] = branches
+    mismatches = {}
+    for sample in samples:
+        if sample.mismatched:
+            key = (sample.label, sample.expected_branch, sample.branch)
+            mismatches[key] = mismatches.get(key, 0) + 1
+    for (label, expected_branch, branch), count in sorted(mismatches.items()):
+        print(f"  MISMATCH {label}: expected {expected_branch}, took {branch} ({count}x)")
+    return summary
+
+def print_row(label, summary):
+    print(f"  {label:<18}{summary['requests']:>6}{summary['p50_ms']:>10.1f}{summary['p95_ms']:>10.1f}"
+          f"{summary['p99_ms']:>10.1f}{summary['first_byte_p50_ms']:>10.1f}")
+
+def compare(results, baseline, tolerance):
+    """Prints p95/p99 regressions beyond `tolerance` (0.2 = 20% slower). Returns how many there were."""
+    regressions = 0
+    for level, summary in results.items():
+        base_level = baseline.get(level)
+        if not base_level:
+            continue
+        rows = [("ALL", summary, base_level)]
+        rows += [(branch, branch_summary, base_level.get("branches", {}).get(branch))
+                 for branch, branch_summary in summary["branches"].items()]
+        for label, current, base in rows:
+            if not base:
+                continue
+            for key in ("p95_ms", "p99_ms"):
+                if base[key] and current[key] > base[key] * (1 + tolerance):
+                    regressions += 1
+                    print(f"REGRESSION concurrency={level} {label} {key}: {base[key]:.1f} -> {current[key]:.1f}")
+    return regressions
+
+
+# --- IN-PROCESS SERVER ---
+
+def start_local_server(router_only):
+    """Imports flask_app on the fake providers and serves it on a free local port."""
+    os.environ.setdefault('PROVIDER_MODE', 'fake')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if router_only:
+        for name in ('FIRESTORE', 'STT', 'LLM', 'TTS'):
+            os.environ[f'FAKE_{name}_LATENCY'] = "0"
+        os.environ['FAKE_LLM_TOKENS_PER_SECOND'] = "1000000"
+        os.environ['FAKE_TTS_REALTIME_FACTOR'] = "1000000"
+    import logging
+    from werkzeug.serving import make_server
+    import flask_app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING) # No access log line per request
+    if flask_app.PROVIDER_MODE != 'fake':
+        sys.exit("The in-process server only runs on fake providers. Use --url for a live server.")
+    server = make_server("127.0.0.1", 0, flask_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Virgo router.")
+    parser.add_argument('--url', help="Base URL of a running server (default: start flask_app in-process on fake providers)")
+    parser.add_argument('--corpus', help="JSON-lines corpus file (default: the built-in shift script)")
+    parser.add_argument('--concurrency', default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument('--rounds', type=int, default=2, help="Times each responder replays the corpus per level")
+    parser.add_argument('--stream', choices=('0', '1'), help="Force streamed (1) or buffered (0) audio replies")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--router-only', action='store_true', help="Zero provider latency, to measure the router itself")
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Baseline JSON from --save; exits 1 on p95/p99 regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown before a regression is flagged")
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip('/') if args.url else start_local_server(args.router_only)
+    url = f"{base_url}/analyze-audio-file" + (f"?stream={args.stream}" if args.stream else "")
+    corpus = load_corpus(args.corpus)
+    corpus_dir = os.path.dirname(os.path.abspath(args.corpus)) if args.corpus else os.getcwd()
+    clips = [(entry['branch'], clip_label(entry), *clip_bytes(entry, corpus_dir)) for entry in corpus]
+    print(f"Benchmarking {url} with {len(clips)} clips per round.")
+
+    run_level(url, clips, 1, 1, args.timeout) # Warm-up: caches, connections, protocol load
+    results = {}
+    for level in [int(level) for level in args.concurrency.split(',')]:
+        samples, wall_seconds = run_level(url, clips, level, args.rounds, args.timeout)
+        results[str(level)] = report_level(level, samples, wall_seconds)
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+        print(f"\nSaved results to {args.save}")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        print(f"\n{regressions} regressions against {args.compare}.")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+# --- Virgo's Whisper AI: local provider stand-ins ---
+# Offline fakes for Firestore, AssemblyAI, Cerebras and ElevenLabs, so the router
+# can be run and benchmarked without accounts or network access.
+# flask_app.py (and asgi_app.py) use them when PROVIDER_MODE=fake.
+#
+# Every fake waits on a LatencyProfile and fails at its error rate. Profiles are
+# set per provider with FAKE_<NAME>_LATENCY="median_ms[,sigma[,error_rate]]",
+# e.g. FAKE_LLM_LATENCY="250,0.4,0.01". Latencies are log-normal around the
+# median, so there is a realistic tail. FAKE_SEED makes runs repeatable.
+
+# --- Imports ---
+import asyncio
+import enum
+import io
+import itertools
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import types
+import wave
+from array import array
+
+import httpx
+
+RNG = random.Random(os.environ.get('FAKE_SEED'))
+
+
+# --- LATENCY & ERROR DISTRIBUTIONS ---
+
+class FakeProviderError(Exception):
+    pass
+
+class LatencyProfile:
+    """Log-normal latency around a median (sigma sets the tail), plus a failure rate."""
+
+    def __init__(self, name, median_ms, sigma=0.3, error_rate=0.0):
+        self.name = name
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    @classmethod
+    def from_env(cls, name, median_ms, sigma=0.3, error_rate=0.0):
+        spec = os.environ.get(f'FAKE_{name}_LATENCY')
+        if spec:
+            parts = [float(part) for part in spec.split(',')]
+            median_ms = parts[0]
+            sigma = parts[1] if len(parts) > 1 else sigma
+            error_rate = parts[2] if len(parts) > 2 else error_rate
+        return cls(name, median_ms, sigma, error_rate)
+
+    def sample(self):
+        """One latency draw, in seconds."""
+        if self.median_ms <= 0:
+            return 0.0
+        return RNG.lognormvariate(math.log(self.median_ms / 1000), self.sigma)
+
+    def check(self):
+        if self.error_rate and RNG.random() < self.error_rate:
+            raise FakeProviderError(f"Simulated {self.name} failure")
+
+    def wait(self):
+        time.sleep(self.sample())
+        self.check()
+
+    async def wait_async(self):
+        await asyncio.sleep(self.sample())
+        self.check()
+
+FIRESTORE_LATENCY = LatencyProfile.from_env('FIRESTORE', 30)
+STT_LATENCY = LatencyProfile.from_env('STT', 900, sigma=0.35)
+LLM_LATENCY = LatencyProfile.from_env('LLM', 250, sigma=0.4)         # Time to first token
+TTS_LATENCY = LatencyProfile.from_env('TTS', 300, sigma=0.3)         # Time to first audio chunk
+LLM_TOKENS_PER_SECOND = float(os.environ.get('FAKE_LLM_TOKENS_PER_SECOND', 1500))
+TTS_REALTIME_FACTOR = float(os.environ.get('FAKE_TTS_REALTIME_FACTOR', 4)) # Audio generated 4x faster than it plays
+
+
+# --- FIRESTORE ---
+
+SAMPLE_PROTOCOLS = {
+    "officer_down": {
+        "name": "Officer Down",
+        "keywords": ["shots fired", "officer down", "im hit"],
+        "steps": "1. Get to cover. 2. Locate the wound. 3. Apply pressure. 4. Confirm location for EMS.",
+        "priority": 10,
+    },
+    "vehicle_collision": {
+        "name": "Vehicle Collision",
+        "keywords": ["car crash", "10-50", "vehicle collision"],
+        "steps": "1. Secure the scene. 2. Count the injured. 3. Check for fuel leaks. 4. Request units.",
+        "priority": 5,
+    },
+    "structure_fire": {
+        "name": "Structure Fire",
+        "keywords": ["structure fire", "smoke showing"],
+        "steps": "1. Size up. 2. Confirm occupants. 3. Establish water supply. 4. Call for ventilation.",
+    },
+}
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = dict(data) if data is not None else None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+class FakeDocumentReference:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    def set(self, data, merge=False):
+        FIRESTORE_LATENCY.wait()
+        self._collection._write(self.id, data, merge)
+
+    def get(self):
+        FIRESTORE_LATENCY.wait()
+        return FakeDocumentSnapshot(self.id, self._collection._read(self.id))
+
+    def delete(self):
+        FIRESTORE_LATENCY.wait()
+        self._collection._delete(self.id)
+
+ChangeType = enum.Enum('ChangeType', 'ADDED MODIFIED REMOVED')
+
+class FakeDocumentChange:
+    def __init__(self, change_type, document):
+        self.type = change_type
+        self.document = document
+
+class FakeWatch:
+    def __init__(self, collection, callback):
+        self._collection = collection
+        self.callback = callback
+
+    def unsubscribe(self):
+        with self._collection._lock:
+            if self in self._collection._watches:
+                self._collection._watches.remove(self)
+
+class FakeQuery:
+    """The subset of Firestore queries the app uses: where, order_by, limit, stream."""
+
+    OPERATORS = {
+        '==': lambda value, target: value == target,
+        '>=': lambda value, target: value is not None and value >= target,
+        '>': lambda value, target: value is not None and value > target,
+        '<=': lambda value, target: value is not None and value <= target,
+        '<': lambda value, target: value is not None and value < target,
+        'in': lambda value, target: value in target,
+    }
+
+    def __init__(self, collection, filters=(), order=None, limit_to=None):
+        self._collection = collection
+        self._filters = filters
+        self._order = order
+        self._limit = limit_to
+
+    def where(self, field, op, value):
+        return FakeQuery(self._collection, self._filters + ((field, self.OPERATORS[op], value),), self._order, self._limit)
+
+    def order_by(self, field, direction="ASCENDING"):
+        return FakeQuery(self._collection, self._filters, (field, direction), self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self._collection, self._filters, self._order, count)
+
+    def stream(self):
+        FIRESTORE_LATENCY.wait()
+        docs = [FakeDocumentSnapshot(doc_id, data) for doc_id, data in self._collection._snapshot()]
+        docs = [doc for doc in docs if all(test(doc._data.get(field), target) for field, test, target in self._filters)]
+        if self._order:
+            field, direction = self._order
+            docs.sort(key=lambda doc: doc._data.get(field, 0), reverse=direction == "DESCENDING")
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return iter(docs)
+
+class FakeCollection(FakeQuery):
+    _auto_ids = itertools.count()
+
+    def __init__(self, name):
+        super().__init__(self)
+        self.name = name
+        self._docs = {}
+        self._lock = threading.Lock()
+        self._watches = []
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self, doc_id or f"fake-{next(self._auto_ids)}")
+
+    def on_snapshot(self, callback):
+        """Like Firestore's listener: every document as ADDED first, then each change as it's written."""
+        watch = FakeWatch(self, callback)
+        with self._lock:
+            self._watches.append(watch)
+            docs = [FakeDocumentSnapshot(doc_id, data) for doc_id, data in self._docs.items()]
+        callback(docs, [FakeDocumentChange(ChangeType.ADDED, doc) for doc in docs], time.time())
+        return watch
+
+    def _notify(self, change_type, doc_id, data):
+        with self._lock:
+            watches = list(self._watches)
+            docs = [FakeDocumentSnapshot(other_id, other) for other_id, other in self._docs.items()]
+        change = FakeDocumentChange(change_type, FakeDocumentSnapshot(doc_id, data))
+        for watch in watches:
+            watch.callback(docs, [change], time.time())
+
+    def _write(self, doc_id, data, merge):
+        with self._lock:
+            existed = doc_id in self._docs
+            if merge and existed:
+                self._docs[doc_id].update(data)
+            else:
+                self._docs[doc_id] = dict(data)
+            written = dict(self._docs[doc_id])
+            watched = bool(self._watches)
+        if watched:
+            self._notify(ChangeType.MODIFIED if existed else ChangeType.ADDED, doc_id, written)
+
+    def _delete(self, doc_id):
+        with self._lock:
+            data = self._docs.pop(doc_id, None)
+            watched = bool(self._watches)
+        if watched and data is not None:
+            self._notify(ChangeType.REMOVED, doc_id, data)
+
+    def _read(self, doc_id):
+        with self._lock:
+            data = self._docs.get(doc_id)
+            return dict(data) if data is not None else None
+
+    def _snapshot(self):
+        with self._lock:
+            return [(doc_id, dict(data)) for doc_id, data in self._docs.items()]
+
+class FakeWriteBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference, data, merge))
+
+    def commit(self):
+        FIRESTORE_LATENCY.wait() # One round trip for the whole batch
+        for reference, data, merge in self._writes:
+            reference._collection._write(reference.id, data, merge)
+
+class FakeFirestore:
+    """An in-memory Firestore client, seeded with some sample protocols."""
+
+    def __init__(self, protocols=None):
+        self._collections = {}
+        self._lock = threading.Lock()
+        for protocol_id, protocol in (protocols or {}).items():
+            self.collection('protocols')._write(protocol_id, protocol, merge=False)
+
+    def collection(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = FakeCollection(name)
+            return self._collections[name]
+
+    def batch(self):
+        return FakeWriteBatch()
+
+
+# --- ASSEMBLYAI ---
+# The fake speech-to-text "hears" text that was spoken into a clip with
+# encode_spoken_text(): each character is held as a short run of samples whose
+# amplitude encodes its byte, surrounded by real silence. The clip still goes
+# through silence trimming like a real recording. Non-WAV uploads are read as
+# plain UTF-8 text, which is handy with curl.
+
+SPOKEN_SAMPLE_RATE = 16000
+SAMPLES_PER_CHAR = 160   # 10 ms per character
+CHAR_BASE_AMPLITUDE = 2000
+CHAR_AMPLITUDE_STEP = 100
+
+def encode_spoken_text(text, sample_rate=SPOKEN_SAMPLE_RATE, padding_seconds=0.5):
+    """A 16-bit mono WAV clip the fake transcriber will read back as `text`."""
+    silence = [0] * int(sample_rate * padding_seconds)
+    samples = array('h', silence)
+    for byte in text.encode('utf-8'):
+        amplitude = CHAR_BASE_AMPLITUDE + byte * CHAR_AMPLITUDE_STEP
+        samples.extend(amplitude if i % 2 else -amplitude for i in range(SAMPLES_PER_CHAR))
+    samples.extend(silence)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+def decode_spoken_text(audio_bytes):
+    try:
+        with wave.open(io.BytesIO(audio_bytes), 'rb') as wav:
+            samples = array('h', wav.readframes(wav.getnframes()))
+    except (wave.Error, EOFError):
+        return audio_bytes.decode('utf-8', errors='ignore').strip()
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    floor = CHAR_BASE_AMPLITUDE // 2
+    start = next((i for i, sample in enumerate(samples) if abs(sample) >= floor), len(samples))
+    decoded = bytearray()
+    for i in range(start + SAMPLES_PER_CHAR // 2, len(samples), SAMPLES_PER_CHAR):
+        amplitude = abs(samples[i])
+        if amplitude < floor:
+            break
+        decoded.append(max(0, min(255, round((amplitude - CHAR_BASE_AMPLITUDE) / CHAR_AMPLITUDE_STEP))))
+    return decoded.decode('utf-8', errors='ignore')
+
+class FakeTranscriber:
+    """Stands in for aai.Transcriber. Statuses compare equal to aai.TranscriptStatus values."""
+
+    def transcribe(self, data):
+        audio_bytes = data.read() if hasattr(data, 'read') else data
+        try:
+            STT_LATENCY.wait()
+        except FakeProviderError as e:
+            return types.SimpleNamespace(status="error", error=str(e), text=None)
+        return types.SimpleNamespace(status="completed", error=None, text=decode_spoken_text(audio_bytes))
+
+class FakeAssemblyAITransport(httpx.AsyncBaseTransport):
+    """
+    Serves AssemblyAI's upload / transcript / poll REST calls for asgi_app's
+    pooled client. A job completes once its sampled latency has passed.
+    """
+
+    def __init__(self):
+        self._uploads = {}
+        self._jobs = {}
+        self._ids = itertools.count()
+
+    async def handle_async_request(self, request):
+        path = request.url.path
+        if path.endswith("/upload"):
+            upload_id = f"upload-{next(self._ids)}"
+            self._uploads[upload_id] = await request.aread()
+            return httpx.Response(200, json={"upload_url": f"fake://{upload_id}"})
+        if path.endswith("/transcript") and request.method == "POST":
+            upload_id = json.loads(await request.aread())['audio_url'].split("://", 1)[1]
+            job_id = f"job-{next(self._ids)}"
+            failed = bool(STT_LATENCY.error_rate) and RNG.random() < STT_LATENCY.error_rate
+            self._jobs[job_id] = (time.time() + STT_LATENCY.sample(), self._uploads.pop(upload_id, b""), failed)
+            return httpx.Response(200, json={"id": job_id, "status": "queued"})
+        job_id = path.rsplit("/", 1)[-1]
+        if job_id not in self._jobs:
+            return httpx.Response(404, json={"error": "Transcript not found"})
+        ready_at, audio_bytes, failed = self._jobs[job_id]
+        if time.time() < ready_at:
+            return httpx.Response(200, json={"id": job_id, "status": "processing"})
+        del self._jobs[job_id]
+        if failed:
+            return httpx.Response(200, json={"id": job_id, "status": "error", "error": "Simulated STT failure"})
+        return httpx.Response(200, json={"id": job_id, "status": "completed", "text": decode_spoken_text(audio_bytes)})
+
+
+# --- CEREBRAS ---
+
+GUIDANCE_REPLIES = [
+    "Okay, I hear you. Get to cover and tell me where you are hurt.",
+    "Understood. Apply firm pressure to the wound with both hands.",
+    "Good. Keep the pressure on. What is your exact location?",
+]
+RESOLVED_WORDS = ("resolved", "clear", "on scene", "ems is here")
+
+def fake_reply(messages):
+    """A plausible reply for each of the app's prompts: guidance, stress JSON or a summary."""
+    system = messages[0]['content']
+    user = messages[-1]['content']
+    if '"is_stressed"' in system:
+        stressed = "!" in user or bool(re.search(r'\b(help|hurt|now|hurry)\b', user.lower()))
+        reason = "Urgent wording." if stressed else "Calm and procedural."
+        return json.dumps({"is_stressed": stressed, "reason": reason})
+    if "PROTOCOL NAME" in system:
+        reply = GUIDANCE_REPLIES[user.count("AI:") % len(GUIDANCE_REPLIES)]
+        if any(word in user.lower() for word in RESOLVED_WORDS):
+            reply = "Good work. Stay with the patient until EMS takes over. [CONVERSATION_COMPLETE]"
+        return reply
+    words = user.split()
+    return "Summary: " + " ".join(words[:24]) + ("..." if len(words) > 24 else "")
+
+def completion(text):
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text))])
+
+def completion_chunk(text):
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text))])
+
+def reply_tokens(text):
+    return re.findall(r'\S+\s*', text)
+
+class FakeChatCompletions:
+    def create(self, model, messages, temperature=None, stream=False, **kwargs):
+        LLM_LATENCY.wait()
+        tokens = reply_tokens(fake_reply(messages))
+        if stream:
+            return self._stream(tokens)
+        time.sleep(len(tokens) / LLM_TOKENS_PER_SECOND)
+        return completion("".join(tokens))
+
+    def _stream(self, tokens):
+        for token in tokens:
+            time.sleep(1 / LLM_TOKENS_PER_SECOND)
+            yield completion_chunk(token)
+
+class FakeCerebras:
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=FakeChatCompletions())
+
+class FakeAsyncChatCompletions:
+    async def create(self, model, messages, temperature=None, stream=False, **kwargs):
+        await LLM_LATENCY.wait_async()
+        tokens = reply_tokens(fake_reply(messages))
+        if stream:
+            return self._stream(tokens)
+        await asyncio.sleep(len(tokens) / LLM_TOKENS_PER_SECOND)
+        return completion("".join(tokens))
+
+    async def _stream(self, tokens):
+        for token in tokens:
+            await asyncio.sleep(1 / LLM_TOKENS_PER_SECOND)
+            yield completion_chunk(token)
+
+class FakeAsyncCerebras:
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=FakeAsyncChatCompletions())
+
+
+# --- ELEVENLABS ---
+# Clips are silent stand-in MP3 bytes sized like 128 kbps speech (~15 characters a second).
+
+AUDIO_BYTES_PER_SECOND = 16000
+CHARS_PER_SECOND = 15
+AUDIO_CHUNK_BYTES = 4096
+
+def fake_audio_chunks(text):
+    size = max(AUDIO_CHUNK_BYTES, int(len(text) / CHARS_PER_SECOND * AUDIO_BYTES_PER_SECOND))
+    return [b"\xff\xfb" + bytes(min(AUDIO_CHUNK_BYTES, size - offset) - 2) for offset in range(0, size, AUDIO_CHUNK_BYTES)]
+
+def chunk_interval():
+    return AUDIO_CHUNK_BYTES / AUDIO_BYTES_PER_SECOND / TTS_REALTIME_FACTOR
+
+class FakeTextToSpeech:
+    def convert(self, text, **kwargs):
+        TTS_LATENCY.wait()
+        chunks = fake_audio_chunks(text)
+        time.sleep(chunk_interval() * (len(chunks) - 1))
+        return iter(chunks)
+
+    def stream(self, text, **kwargs):
+        TTS_LATENCY.wait()
+        chunks = fake_audio_chunks(text)
+        yield chunks[0]
+        for chunk in chunks[1:]:
+            time.sleep(chunk_interval())
+            yield chunk
+
+class FakeElevenLabs:
+    def __init__(self):
+        self.text_to_speech = FakeTextToSpeech()
+
+class FakeAsyncTextToSpeech:
+    async def stream(self, text, **kwargs):
+        await TTS_LATENCY.wait_async()
+        chunks = fake_audio_chunks(text)
+        yield chunks[0]
+        for chunk in chunks[1:]:
+            await asyncio.sleep(chunk_interval())
+            yield chunk
+
+class FakeAsyncElevenLabs:
+    def __init__(self):
+        self.text_to_speech = FakeAsyncTextToSpeech()
@@ -1,19 +1,30 @@
 # --- Imports ---
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS # For web demo
-import firebase_admin
-from firebase_admin import credentials, firestore
 import os
 from dotenv import load_dotenv
 import time
+import math
 import json
+import io
+import sys
+import wave
+from array import array
+import hashlib
 import string
-from cerebras.cloud.sdk import Cerebras
-import assemblyai as aai
-from elevenlabs.client import ElevenLabs
-
-# --- Global variable to hold our AI's "expert knowledge" ---
-PROTOCOL_LIBRARY = []
+import re
+import queue
+import itertools
+import threading
+import atexit
+import bisect
+import logging
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_for_futures, TimeoutError as FutureTimeout
+from collections import deque, OrderedDict
+# The Firebase, AssemblyAI, Cerebras and ElevenLabs SDKs are imported in the
+# background by init_firebase() / init_provider_clients(), not here.
 
 # --- Setup ---
 # Build Absolute Paths
@@ -21,135 +32,1135 @@ project_dir = os.path.dirname(os.path.abspath(__file__))
 key_path = os.path.join(project_dir, "serviceAccountKey.json")
 dotenv_path = os.path.join(project_dir, ".env") 
 
-# Load the .env file
+# Load the .env file before anything below reads its settings
 load_dotenv(dotenv_path) 
 
+# --- (NEW) v3.9: LEVELED LOGGING ---
+# LOG_LEVEL is DEBUG, INFO, WARNING, ERROR or OFF. LOG_FORMAT=json writes one
+# JSON object per line for log shippers; the default is plain text.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def configure_logging():
+    handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    virgo_logger = logging.getLogger("virgo")
+    virgo_logger.handlers = [handler]
+    virgo_logger.propagate = False
+    if LOG_LEVEL == 'OFF':
+        virgo_logger.setLevel(logging.CRITICAL + 1)
+    else:
+        virgo_logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    return virgo_logger
+
+logger = configure_logging()
+
+# --- (NEW) v3.9: PER-STAGE LATENCY METRICS ---
+# Every expensive step runs inside timed("<stage>"). Each span is added to a
+# latency histogram (served on /metrics in Prometheus text format) and to the
+# current request's Server-Timing header.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRIC_HELP = {
+    "virgo_stage_duration_seconds": "Time spent in each pipeline stage.",
+    "virgo_request_duration_seconds": "Time from request start to the last byte of the response, by route and branch.",
+    "virgo_llm_cache_requests_total": "Cacheable LLM calls, by whether they were a cache hit, a miss, or coalesced into an identical call in flight.",
+}
+
+class LatencyHistograms:
+    """Thread-safe Prometheus-style histograms (and plain counters), one series per (metric, labels)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._series = {} # (metric, labels) -> [bucket counts..., +Inf count, sum]
+        self._counters = {} # (metric, labels) -> count
+        self._lock = threading.Lock()
+
+    def count(self, metric, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def observe(self, metric, seconds, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, seconds)] += 1
+            series[-1] += seconds
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted((key, list(series)) for key, series in self._series.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        last_metric = None
+        for (metric, labels), series in snapshot:
+            if metric != last_metric:
+                lines.append(f"# HELP {metric} {METRIC_HELP.get(metric, metric)}")
+                lines.append(f"# TYPE {metric} histogram")
+                last_metric = metric
+            label_text = "".join(f'{name}="{value}",' for name, value in labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{label_text}le="{bound}"}} {cumulative}')
+            label_set = "{" + label_text.rstrip(",") + "}" if label_text else ""
+            lines.append(f"{metric}_sum{label_set} {series[-1]:.6f}")
+            lines.append(f"{metric}_count{label_set} {cumulative}")
+        last_metric = None
+        for (metric, labels), count in counters:
+            if metric != last_metric:
+                lines.append(f"# HELP {metric} {METRIC_HELP.get(metric, metric)}")
+                lines.append(f"# TYPE {metric} counter")
+                last_metric = metric
+            label_set = "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}" if labels else ""
+            lines.append(f"{metric}{label_set} {count}")
+        return "\n".join(lines) + "\n"
+
+METRICS = LatencyHistograms()
+
+class RequestTimings:
+    """The stage spans of one request, for its Server-Timing header."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.branch = "none"
+        self.stages = OrderedDict() # stage -> total seconds
+        self.streaming_body = False # Set when the request is timed when its body finishes, not in after_request
+        self.in_body = False        # Set once the response has started: later calls get their own timeout, not the request's
+        self.budget_started = self.started # Moved by restart_budget() past waits the deadline doesn't cover
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+# A context variable, so spans find their request from Flask threads and asyncio tasks alike
+CURRENT_TIMINGS = contextvars.ContextVar('current_timings', default=None)
+
+def record_stage(stage, seconds):
+    METRICS.observe("virgo_stage_duration_seconds", seconds, stage=stage)
+    timings = CURRENT_TIMINGS.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+def set_branch(branch):
+    """Labels the current request with the router branch it took."""
+    timings = CURRENT_TIMINGS.get()
+    if timings is not None:
+        timings.branch = branch
+
+def restart_budget():
+    """Starts the current request's deadline over from now, for time its deadline shouldn't cover."""
+    timings = CURRENT_TIMINGS.get()
+    if timings is not None:
+        timings.budget_started = time.perf_counter()
+
+def finish_request_timing(timings, route, status):
+    METRICS.observe("virgo_request_duration_seconds", timings.elapsed(),
+                    route=route, branch=timings.branch, status=str(status))
+
+# --- (NEW) v3.9: DEADLINES, HEDGED CALLS & CIRCUIT BREAKERS ---
+# Every upstream call runs under a timeout cut from the request's overall budget,
+# so a hung provider can't hold a worker. Idempotent calls that run past the
+# provider's usual p95 get one duplicate ("hedged") request, and the first answer
+# wins. After repeated failures a provider's breaker opens and calls fail fast
+# to a fallback (protocol step, cached summary, text-only reply) until a trial
+# call succeeds again.
+
+REQUEST_BUDGET_SECONDS = float(os.environ.get('REQUEST_BUDGET_SECONDS', 5.0))
+MIN_CALL_SECONDS = 0.25       # Even a nearly spent budget gets one short try
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20        # Don't hedge until we know what "slow" is
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', 30))
+PROVIDER_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get('PROVIDER_POOL_SIZE', 32)), thread_name_prefix="provider")
+
+class ProviderUnavailable(Exception):
+    """The provider's circuit breaker is open, or the call ran out of time."""
+
+class ProviderGuard:
+    """Deadline, hedging and circuit breaker for one upstream provider."""
+
+    def __init__(self, name, timeout, reserve=0.0):
+        self.name = name
+        self.timeout = timeout  # Longest a single call may take
+        self.reserve = reserve  # Budget left for the stages that come after this one
+        self._latencies = deque(maxlen=200)
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def time_left(self):
+        """This call's timeout: the provider's own limit, cut short by the request's deadline."""
+        timings = CURRENT_TIMINGS.get()
+        if timings is None or timings.in_body:
+            return self.timeout
+        remaining = timings.budget_started + REQUEST_BUDGET_SECONDS - time.perf_counter() - self.reserve
+        return max(MIN_CALL_SECONDS, min(self.timeout, remaining))
+
+    def hedge_delay(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[int(len(latencies) * HEDGE_PERCENTILE / 100) - 1]
+
+    def allow(self):
+        """Closed: yes. Open: no, until BREAKER_RESET_SECONDS pass, then one trial call at a time."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_running or time.time() - self._opened_at < BREAKER_RESET_SECONDS:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._failures = 0
+            if self._opened_at is not None:
+                logger.info(f"{self.name} recovered. Closing its circuit breaker.")
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= BREAKER_FAILURES:
+                if self._opened_at is None:
+                    logger.warning(f"{self.name} failed {self._failures} times in a row. Opening its circuit breaker.")
+                self._opened_at = time.time()
+
+    def abandon(self):
+        """The caller gave up before the call finished: let the next call be the trial."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_miss(self, error, allowed):
+        """
+        A call that returned no result. It counts against the provider only if
+        it raised, or ran past the provider's own timeout; a call that the
+        request's deadline cut shorter than that is just abandoned.
+        """
+        if error is not None or allowed >= self.timeout:
+            self.record_failure()
+        else:
+            self.abandon()
+
+    def call(self, make_call, hedge=False):
+        """
+        Runs make_call() on the provider pool and returns its result, or raises
+        ProviderUnavailable / the call's own exception. With hedge=True a second
+        identical call is started once the first passes the usual p95 latency.
+        """
+        if not self.allow():
+            raise ProviderUnavailable(f"{self.name} is unavailable (circuit open)")
+        started = time.perf_counter()
+        deadline = started + self.time_left()
+        hedge_delay = self.hedge_delay() if hedge else None
+        hedge_at = started + hedge_delay if hedge_delay is not None else None
+        # Each attempt runs in its own copy of this request's context, so its spans are still attributed to it
+        pending = {PROVIDER_POOL.submit(contextvars.copy_context().run, make_call)}
+        error = None
+        while pending:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            wake_at = min(deadline, hedge_at) if hedge_at else deadline
+            done, pending = wait_for_futures(pending, timeout=wake_at - now, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.record_success(time.perf_counter() - started)
+                    return future.result()
+                error = future.exception()
+            if pending and hedge_at and time.perf_counter() >= hedge_at:
+                logger.info(f"{self.name} call passed its p{HEDGE_PERCENTILE} ({hedge_delay:.2f}s). Sending a hedged request.")
+                pending.add(PROVIDER_POOL.submit(contextvars.copy_context().run, make_call))
+                hedge_at = None
+        self.record_miss(error, deadline - started)
+        if error is not None and not pending:
+            raise error
+        raise ProviderUnavailable(f"{self.name} did not answer within {deadline - started:.1f}s")
+
+CEREBRAS_GUARD = ProviderGuard("cerebras", float(os.environ.get('LLM_TIMEOUT_SECONDS', 1.5)), reserve=0.5)
+ELEVENLABS_GUARD = ProviderGuard("elevenlabs", float(os.environ.get('TTS_TIMEOUT_SECONDS', 1.0)))
+# Whole clips (generate_voice_audio) take as long as the audio does, not just the first chunk,
+# so they get their own timeout and latency history
+ELEVENLABS_CLIP_GUARD = ProviderGuard("elevenlabs_clip", float(os.environ.get('TTS_CLIP_TIMEOUT_SECONDS', 4.0)))
+# Batch transcription has no guard: it can't be hedged or degraded, and without a
+# transcript there is nothing to route. What it can do is notice sooner that the
+# job is done than the SDK's 3-second default poll.
+ASSEMBLYAI_POLLING_INTERVAL = float(os.environ.get('ASSEMBLYAI_POLLING_INTERVAL', 0.5))
+
+# --- (NEW) v3.9: LLM CALL COALESCING & RESULT CACHE ---
+# Units on the same channel often ask for the same summary or debrief within
+# seconds, and radio chatter repeats. Identical prompts (same model, temperature
+# and messages) share one in-flight call, and the result is reused for a while.
+
+LLM_CACHE_TTL_SECONDS = float(os.environ.get('LLM_CACHE_TTL_SECONDS', 60)) # 0 = coalesce only
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 512))
+
+class LLMCallCache:
+    """Single-flight plus a TTL'd LRU of results, for calls whose prompt fully determines the answer."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires at, result)
+        self._in_flight = {}          # key -> Future, for the sync app
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, temperature, messages):
+        return hashlib.sha256(json.dumps([model, temperature, messages], sort_keys=True).encode()).hexdigest()
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        METRICS.count("virgo_llm_cache_requests_total", result="hit")
+        return entry[1]
+
+    def store(self, key, result):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def call(self, key, make_call, timeout):
+        """
+        The cached result, or the result of an identical call already in flight
+        (waiting at most `timeout`), or make_call()'s. Failures are not cached,
+        but every caller waiting on a failed call gets its exception.
+        """
+        cached = self.lookup(key)
+        if cached is not None:
+            return cached
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        if not leader:
+            METRICS.count("virgo_llm_cache_requests_total", result="coalesced")
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeout:
+                raise ProviderUnavailable(f"Identical LLM call did not finish within {timeout:.1f}s")
+        METRICS.count("virgo_llm_cache_requests_total", result="miss")
+        try:
+            result = make_call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self.store(key, result)
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+LLM_CACHE = LLMCallCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS)
+
+def cached_completion(model, messages, temperature):
+    """
+    chat.completions.create through the Cerebras guard (with hedging) and the
+    LLM cache. For summaries, debriefs, stress checks and other calls that
+    don't carry a responder's own conversation state.
+    """
+    key = LLM_CACHE.make_key(model, temperature, messages)
+    return LLM_CACHE.call(key, lambda: CEREBRAS_GUARD.call(lambda: cerebras_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        timeout=CEREBRAS_GUARD.timeout
+    ), hedge=True), CEREBRAS_GUARD.time_left())
+
 # 1. Initialize Flask App
 app = Flask(__name__)
 CORS(app) # Enable CORS for our web demo
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES # Bigger uploads are refused with a 413
+
+# Set PROVIDER_MODE=fake to run on the local stand-ins in fake_providers.py
+# instead of Firebase, AssemblyAI, Cerebras and ElevenLabs (see benchmark.py).
+PROVIDER_MODE = os.environ.get('PROVIDER_MODE', 'live').lower()
+if PROVIDER_MODE == 'fake':
+    import fake_providers
+
+# (NEW) v3.9: Set by init_firebase() and init_provider_clients(), which run in
+# the background at startup (see BACKGROUND STARTUP & READINESS)
+db = None
+transcriber = None
+cerebras_client = None
+elevenlabs_client = None
+firebase_connected = False
+keys_loaded = False
+
+DESCENDING = "DESCENDING" # firestore.Query.DESCENDING
 
 # 2. Initialize Firebase
-try:
-    cred = credentials.Certificate(key_path)
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Firebase connection successful.")
-    firebase_connected = True
-except Exception as e:
-    print(f"Error initializing Firebase: {e}")
-    firebase_connected = False
+def init_firebase():
+    global db, firebase_connected
+    if PROVIDER_MODE == 'fake':
+        db = fake_providers.FakeFirestore(fake_providers.SAMPLE_PROTOCOLS)
+        firebase_connected = True
+        logger.warning("PROVIDER_MODE=fake: using local provider stand-ins.")
+        return
+    try:
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+        cred = credentials.Certificate(key_path)
+        firebase_admin.initialize_app(cred)
+        db = firestore.client()
+        logger.info("Firebase connection successful.")
+        firebase_connected = True
+    except Exception as e:
+        logger.error(f"Error initializing Firebase: {e}")
+        firebase_connected = False
 
 # 3. Load API Keys & Initialize Clients
-try:
-    ASSEMBLYAI_API_KEY = os.environ.get('ASSEMBLYAI_API_KEY')
-    CEREBRAS_API_KEY = os.environ.get('CEREBRAS_API_KEY')
-    ELEVENLABS_API_KEY = os.environ.get('ELEVENLABS_API_KEY')
+def init_provider_clients():
+    global transcriber, cerebras_client, elevenlabs_client, keys_loaded
+    if PROVIDER_MODE == 'fake':
+        transcriber = fake_providers.FakeTranscriber()
+        cerebras_client = fake_providers.FakeCerebras()
+        elevenlabs_client = fake_providers.FakeElevenLabs()
+        keys_loaded = True
+        return
+    try:
+        ASSEMBLYAI_API_KEY = os.environ.get('ASSEMBLYAI_API_KEY')
+        CEREBRAS_API_KEY = os.environ.get('CEREBRAS_API_KEY')
+        ELEVENLABS_API_KEY = os.environ.get('ELEVENLABS_API_KEY')
     
-    if not all([ASSEMBLYAI_API_KEY, CEREBRAS_API_KEY, ELEVENLABS_API_KEY]):
-        raise KeyError("One or more API keys are missing.")
+        if not all([ASSEMBLYAI_API_KEY, CEREBRAS_API_KEY, ELEVENLABS_API_KEY]):
+            raise KeyError("One or more API keys are missing.")
     
-    aai.settings.api_key = ASSEMBLYAI_API_KEY
-    cerebras_client = Cerebras(api_key=CEREBRAS_API_KEY)
-    elevenlabs_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
+        import assemblyai as aai
+        from cerebras.cloud.sdk import Cerebras
+        from elevenlabs.client import ElevenLabs
+        aai.settings.api_key = ASSEMBLYAI_API_KEY
+        aai.settings.polling_interval = ASSEMBLYAI_POLLING_INTERVAL
+        transcriber = aai.Transcriber()
+        cerebras_client = Cerebras(api_key=CEREBRAS_API_KEY)
+        elevenlabs_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
     
-    print("All API keys loaded. Clients initialized.")
-    keys_loaded = True
-except Exception as e:
-    print(f"Error loading API keys or initializing clients: {e}.")
-    keys_loaded = False
+        logger.info("All API keys loaded. Clients initialized.")
+        keys_loaded = True
+    except Exception as e:
+        logger.error(f"Error loading API keys or initializing clients: {e}.")
+        keys_loaded = False
 
 
 # --- (NEW) v3.0: PROTOCOL & CONVERSATION LOGIC ---
 
+def protocol_from_doc(doc):
+    protocol = doc.to_dict()
+    protocol['id'] = doc.id # Store the document ID
+    return protocol
+
 def load_protocols_from_firebase():
     """
-    Loads all protocol documents from Firebase into our global PROTOCOL_LIBRARY.
+    Loads all protocol documents from Firebase into a new version of the
+    protocol registry (PROTOCOLS).
     """
-    global PROTOCOL_LIBRARY
     if not firebase_connected:
-        print("Error: Cannot load protocols, Firebase not connected.")
+        logger.error("Cannot load protocols, Firebase not connected.")
         return
     
     try:
-        print("Loading protocols from Firebase...")
+        logger.info("Loading protocols from Firebase...")
         docs = db.collection('protocols').stream()
-        PROTOCOL_LIBRARY = [] # Clear the old library
-        for doc in docs:
-            protocol = doc.to_dict()
-            protocol['id'] = doc.id # Store the document ID
-            PROTOCOL_LIBRARY.append(protocol)
-        print(f"Successfully loaded {len(PROTOCOL_LIBRARY)} protocols.")
+        version = PROTOCOLS.replace_all({doc.id: protocol_from_doc(doc) for doc in docs})
+        logger.info(f"Successfully loaded {len(version.protocols)} protocols ({version.matcher.keyword_count} keywords compiled, version {version.number}).")
+        save_protocol_snapshot(version)
+        OPENING_LINES.refresh(version)
+        READINESS.set("protocols", "live")
     except Exception as e:
-        print(f"Error loading protocols: {e}")
+        logger.error(f"Error loading protocols: {e}")
 
-def check_for_protocol_trigger(text):
+# --- (NEW) v3.9: COMPILED PROTOCOL TRIGGER MATCHER ---
+
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+def normalize_transcript(text):
     """
-    Scans the transcript for any keywords from our loaded protocols.
+    Lowercases and strips punctuation. Transcripts and keywords both go through
+    this, so "10-50" in a protocol matches "10-50" on the radio.
     """
-    clean_text = text.lower().translate(str.maketrans('', '', string.punctuation))
-    for protocol in PROTOCOL_LIBRARY:
-        for keyword in protocol.get('keywords', []):
-            if keyword in clean_text:
-                print(f"Protocol trigger detected! Keyword: '{keyword}', Protocol: '{protocol.get('name')}'")
-                return protocol # Return the matched protocol
-    return None
+    return (text or "").lower().translate(PUNCTUATION_TABLE)
 
-def get_active_conversation():
+class ProtocolTriggerMatcher:
     """
-    Checks Firebase for an active conversation (e.g., one from the last 2 minutes).
+    An Aho-Corasick automaton built over *words* instead of characters.
+    Every keyword of every protocol is matched in a single pass over the
+    transcript, and only on whole-word boundaries ("crash" won't fire on "crashed").
     """
+
+    def __init__(self, protocols):
+        self._goto = [{}]   # state -> {word: next state}
+        self._fail = [0]    # state -> fallback state
+        self._output = [[]] # state -> [(protocol, keyword, word count)]
+        self.keyword_count = 0
+        for protocol in protocols:
+            for keyword in protocol.get('keywords', []):
+                words = normalize_transcript(keyword).split()
+                if words:
+                    self._add_keyword(words, protocol, keyword)
+        self._build_failure_links()
+
+    def _add_keyword(self, words, protocol, keyword):
+        state = 0
+        for word in words:
+            if word not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][word] = len(self._goto) - 1
+            state = self._goto[state][word]
+        self._output[state].append((protocol, keyword, len(words)))
+        self.keyword_count += 1
+
+    def _build_failure_links(self):
+        # Breadth-first, so a state's fallback is always resolved before its children
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and word not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(word, 0)
+                # Inherit shorter keywords that end at the same place
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find_all(self, clean_text):
+        """
+        Returns every keyword hit in an already-normalized transcript,
+        highest protocol priority first, then earliest in the transcript.
+        """
+        matches = []
+        state = 0
+        for position, word in enumerate(clean_text.split()):
+            while state and word not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(word, 0)
+            for protocol, keyword, word_count in self._output[state]:
+                matches.append({
+                    "protocol": protocol,
+                    "keyword": keyword,
+                    "start": position - word_count + 1,
+                    "end": position + 1,
+                    "priority": protocol_priority(protocol),
+                })
+        matches.sort(key=lambda m: (-m['priority'], m['start']))
+        return matches
+
+def find_protocol(protocol_id):
+    """Looks up a loaded protocol by its document id."""
+    return PROTOCOLS.current.get(protocol_id)
+
+def protocol_priority(protocol):
+    """Protocols may carry an optional numeric 'priority' field (higher wins)."""
     try:
-        # Get the most recent conversation doc
-        docs_stream = db.collection('conversations') \
-                        .order_by('last_update', direction=firestore.Query.DESCENDING) \
-                        .limit(1) \
-                        .stream()
-        
-        docs = list(docs_stream)
-        if not docs:
-            print("No active conversation found.")
-            return None # No conversations found
-        
-        convo = docs[0].to_dict()
-        convo_id = docs[0].id
-        
-        # Check if it's still active (e.g., within 2 minutes)
-        time_since_update = time.time() - convo.get('last_update', 0)
-        
-        if time_since_update < 120 and convo.get('state') != 'complete':
-            print(f"Active conversation found: {convo_id}")
-            return docs[0] 
-        else:
-            print("Found an old conversation, but it has expired or is complete.")
-            return None
-            
-    except Exception as e:
-        print(f"Error getting active conversation: {e}")
+        return int(protocol.get('priority', 0))
+    except (TypeError, ValueError):
+        return 0
+
+def find_protocol_triggers(clean_text):
+    """
+    Returns all protocol keyword matches for a normalized transcript.
+    """
+    return PROTOCOLS.current.matcher.find_all(clean_text)
+
+def check_for_protocol_trigger(clean_text):
+    """
+    Scans a normalized transcript for any keywords from our loaded protocols
+    and returns the highest-priority protocol that matched.
+    """
+    matches = find_protocol_triggers(clean_text)
+    if not matches:
         return None
+    best = matches[0]
+    logger.info(f"Protocol trigger detected! Keyword: '{best['keyword']}', Protocol: '{best['protocol'].get('name')}' ({len(matches)} matches)")
+    return best['protocol'] # Return the matched protocol
+
+# --- (NEW) v3.9: VERSIONED PROTOCOL REGISTRY ---
+
+# Apply protocol edits from a Firestore snapshot listener as they happen,
+# instead of only on startup and POST /reload-protocols.
+PROTOCOL_WATCH = os.environ.get('PROTOCOL_WATCH', 'true').lower() not in ('0', 'false', 'no')
+
+class CompiledProtocol:
+    """A protocol with its system prompt section and steps rendered ahead of time."""
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.system_prompt = GUIDANCE_SYSTEM_PROMPT.format(
+            protocol_name=protocol.get('name', 'N/A'),
+            protocol_steps=protocol.get('steps', 'N/A')
+        )
+        # The 'steps' text ("1. Do this. 2. Then that.") split into steps
+        steps = re.split(r'(?:^|\s)\d+[.)]\s+', protocol.get('steps') or "")
+        self.steps = [step.strip() for step in steps if step.strip()]
+
+class ProtocolVersion:
+    """
+    One immutable snapshot of the protocol library: the protocols, an id index,
+    the trigger matcher and every protocol's compiled prompt. Nothing in it
+    changes after it is built, so a request can keep using the version it
+    started with while a newer one is swapped in.
+    """
+
+    def __init__(self, number, by_id, previous=None):
+        self.number = number
+        self.by_id = by_id
+        self.protocols = list(by_id.values())
+        self.matcher = ProtocolTriggerMatcher(self.protocols)
+        self._compiled = {}
+        for protocol_id, protocol in by_id.items():
+            compiled = previous._compiled.get(protocol_id) if previous else None
+            # Only new and edited protocols are rendered again
+            if compiled is None or compiled.protocol is not protocol:
+                compiled = CompiledProtocol(protocol)
+            self._compiled[protocol_id] = compiled
+
+    def get(self, protocol_id):
+        return self.by_id.get(protocol_id)
+
+    def compiled(self, protocol):
+        compiled = self._compiled.get(protocol.get('id'))
+        if compiled is not None and compiled.protocol is protocol:
+            return compiled
+        return CompiledProtocol(protocol) # A protocol from an older version
+
+class ProtocolRegistry:
+    """
+    Holds the current ProtocolVersion. Changes build a new version from the
+    old one and swap it in with a single assignment.
+    """
+
+    def __init__(self):
+        self.current = ProtocolVersion(0, {})
+        self._lock = threading.Lock() # Serializes writers; readers never wait
+        self._watch = None
+
+    def apply(self, upserts, removed_ids=(), replace=False):
+        """
+        Adds or replaces `upserts` ({id: protocol}) and drops `removed_ids`.
+        With replace=True, `upserts` is the whole library. Unchanged protocols
+        keep their compiled prompts. Returns the version now current.
+        """
+        with self._lock:
+            previous = self.current
+            by_id = {} if replace else dict(previous.by_id)
+            changed = replace and len(upserts) != len(previous.by_id)
+            for protocol_id, protocol in upserts.items():
+                old = previous.by_id.get(protocol_id)
+                if old == protocol:
+                    by_id[protocol_id] = old
+                else:
+                    by_id[protocol_id] = protocol
+                    changed = True
+            for protocol_id in removed_ids:
+                changed = by_id.pop(protocol_id, None) is not None or changed
+            if changed:
+                self.current = ProtocolVersion(previous.number + 1, by_id, previous)
+            return self.current
+
+    def replace_all(self, protocols):
+        return self.apply(protocols, replace=True)
+
+    def on_snapshot(self, docs, changes, read_time):
+        """Firestore snapshot callback: applies the changed documents only."""
+        upserts, removed_ids = {}, []
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                removed_ids.append(change.document.id)
+            else:
+                upserts[change.document.id] = protocol_from_doc(change.document)
+        try:
+            previous = self.current.number
+            version = self.apply(upserts, removed_ids)
+            if version.number != previous:
+                logger.info(f"Protocols updated to version {version.number}: "
+                            f"{len(upserts)} added or changed, {len(removed_ids)} removed.")
+                save_protocol_snapshot(version)
+                OPENING_LINES.refresh(version)
+        except Exception as e:
+            logger.error(f"Error applying protocol changes: {e}")
+
+    def watch(self, collection):
+        """Starts the snapshot listener. Its first callback repeats the current library, which is a no-op."""
+        if self._watch is None:
+            self._watch = collection.on_snapshot(self.on_snapshot)
+            logger.info("Watching Firebase for protocol changes.")
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+PROTOCOLS = ProtocolRegistry()
 
-def update_conversation_state(convo_id, new_state_data):
+# (NEW) v3.9: The last library seen, on disk, so a fresh worker can route
+# protocols before Firebase answers. All workers on a host share the one file.
+PROTOCOL_SNAPSHOT_PATH = os.environ.get('PROTOCOL_SNAPSHOT_PATH', os.path.join(project_dir, "protocol_snapshot.json"))
+
+def load_protocol_snapshot():
+    """Loads the on-disk snapshot into PROTOCOLS. Returns False if there is none."""
+    try:
+        with open(PROTOCOL_SNAPSHOT_PATH) as snapshot_file:
+            protocols = json.load(snapshot_file)['protocols']
+        version = PROTOCOLS.replace_all(protocols)
+        OPENING_LINES.refresh(version)
+        logger.info(f"Loaded {len(version.protocols)} protocols from the local snapshot.")
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.error(f"Error loading the protocol snapshot: {e}")
+        return False
+
+def save_protocol_snapshot(version):
+    """Writes the snapshot atomically, so another worker never reads half a file."""
+    temp_path = f"{PROTOCOL_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump({"saved_at": time.time(), "protocols": version.by_id}, snapshot_file, default=str)
+        os.replace(temp_path, PROTOCOL_SNAPSHOT_PATH)
+    except Exception as e:
+        logger.error(f"Error saving the protocol snapshot: {e}")
+
+# --- (NEW) v3.9: IN-PROCESS CONVERSATION SESSIONS ---
+
+CONVERSATION_TTL_SECONDS = 120
+SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', 1.0))
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', 30.0))
+
+# Each radio/device sends its own responder_id with every clip. Clients that
+# don't (older builds) all share this one.
+DEFAULT_RESPONDER_ID = "default"
+RESPONDER_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+class ConversationSession:
+    """
+    A live conversation held in memory, keyed by responder id. It has the same
+    .id / .to_dict() shape as a Firestore snapshot, so the conversation
+    handlers take either.
+    """
+
+    def __init__(self, responder_id, state):
+        self.id = responder_id
+        self.state = dict(state)
+
+    def to_dict(self):
+        return dict(self.state)
+
+    def is_active(self, now=None):
+        now = now or time.time()
+        time_since_update = now - self.state.get('last_update', 0)
+        return time_since_update < CONVERSATION_TTL_SECONDS and self.state.get('state') != 'complete'
+
+class ConversationSessionStore:
+    """
+    The authoritative copy of active conversations, one per responder. Reads
+    never touch Firestore; writes are persisted in the background
+    (write-behind) to conversations/{responder_id}, except that a conversation
+    which completes is flushed straight away.
+
+    Authoritative only for the responders this process serves: with several
+    worker processes, every request from a responder must reach the same
+    worker (route on responder_id), or run a single worker with threads.
+    Otherwise workers miss each other's conversations and overwrite each
+    other's turns.
+    """
+
+    def __init__(self, flush_interval, sweep_interval):
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self._sessions = {} # responder_id -> ConversationSession
+        self._dirty = set()
+        self._replaced = set() # New conversations overwrite the document instead of merging
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._recovered = False # Until recover() has run, conversations we don't hold are read from Firestore
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def get_active(self, responder_id):
+        """Returns this responder's conversation if it is still active."""
+        with self._lock:
+            session = self._sessions.get(responder_id)
+            if session and session.is_active():
+                return ConversationSession(session.id, session.state)
+            if session or self._recovered or not firebase_connected:
+                return None
+        return self._load(responder_id)
+
+    def _load(self, responder_id):
+        """One responder's conversation, read from Firestore while recover() hasn't run yet."""
+        try:
+            doc = db.collection('conversations').document(responder_id).get()
+        except Exception as e:
+            logger.warning(f"Error reading conversation {responder_id}, treating it as new: {e}")
+            return None
+        if not doc.exists:
+            return None
+        with self._lock:
+            session = self._sessions.setdefault(responder_id, ConversationSession(doc.id, doc.to_dict()))
+            if session.is_active():
+                return ConversationSession(session.id, session.state)
+            return None
+
+    def update(self, responder_id, new_state_data, start_new=False):
+        """Applies new state to a responder's conversation. start_new replaces any old one."""
+        with self._lock:
+            if start_new or responder_id not in self._sessions:
+                self._sessions[responder_id] = ConversationSession(responder_id, {})
+                self._replaced.add(responder_id)
+            self._sessions[responder_id].state.update(new_state_data)
+            self._dirty.add(responder_id)
+        if new_state_data.get('state') == 'complete':
+            self._wakeup.set() # Flush-on-complete
+        return responder_id
+
+    def amend_last_reply(self, responder_id, ai_message):
+        """Rewrites the AI's side of the newest turn, and keeps the conversation open for the rest."""
+        with self._lock:
+            session = self._sessions.get(responder_id)
+            turns = session.state.get('turns') if session else None
+            if not turns:
+                return
+            # A new list: readers may still hold the old one
+            session.state['turns'] = turns[:-1] + [dict(turns[-1], ai=ai_message)]
+            session.state['state'] = 'active'
+            session.state['last_update'] = time.time()
+            self._dirty.add(responder_id)
+
+    def recover(self):
+        """
+        Reloads conversations that were still active in Firestore, e.g. after a restart.
+        """
+        cutoff = time.time() - CONVERSATION_TTL_SECONDS
+        docs = db.collection('conversations').where('last_update', '>=', cutoff).stream()
+        recovered = 0
+        with self._lock:
+            for doc in docs:
+                session = ConversationSession(doc.id, doc.to_dict())
+                # Conversations already loaded or updated since startup are newer than this
+                if session.is_active() and doc.id not in self._sessions:
+                    self._sessions[doc.id] = session
+                    recovered += 1
+            self._recovered = True
+        logger.info(f"Recovered {recovered} active conversations from Firebase.")
+
+    def flush(self):
+        """Writes every changed conversation to Firestore. Failed writes are retried next flush."""
+        with self._flush_lock:
+            with self._lock:
+                pending = [(responder_id, self._sessions[responder_id].to_dict(), responder_id in self._replaced)
+                           for responder_id in self._dirty]
+                self._dirty.clear()
+                self._replaced.clear()
+            for responder_id, state, replace in pending:
+                try:
+                    with timed("firestore_session_write"):
+                        db.collection('conversations').document(responder_id).set(state, merge=not replace)
+                except Exception as e:
+                    logger.warning(f"Error persisting conversation {responder_id}, will retry: {e}")
+                    with self._lock:
+                        self._dirty.add(responder_id)
+                        if replace:
+                            self._replaced.add(responder_id)
+
+    def sweep(self):
+        """Drops complete or expired conversations that have already been saved."""
+        now = time.time()
+        with self._lock:
+            finished = [r for r, session in self._sessions.items() if not session.is_active(now) and r not in self._dirty]
+            for responder_id in finished:
+                del self._sessions[responder_id]
+        if finished:
+            logger.info(f"Swept {len(finished)} finished conversations.")
+
+    def _run(self):
+        last_sweep = time.time()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if firebase_connected:
+                self.flush()
+            if time.time() - last_sweep >= self.sweep_interval:
+                self.sweep()
+                last_sweep = time.time()
+
+SESSION_STORE = ConversationSessionStore(SESSION_FLUSH_INTERVAL, SESSION_SWEEP_INTERVAL)
+
+def get_active_conversation(responder_id):
     """
-    Creates or updates a conversation document in Firebase.
+    Returns the responder's active conversation (e.g., one from the last 2 minutes) from the session store.
+    """
+    with timed("session_lookup"):
+        convo = SESSION_STORE.get_active(responder_id)
+    if convo:
+        logger.debug(f"Active conversation found for responder: {responder_id}")
+    else:
+        logger.debug(f"No active conversation for responder: {responder_id}")
+    return convo
+
+def update_conversation_state(responder_id, new_state_data, start_new=False):
+    """
+    Creates or updates a responder's conversation. The session store persists it to Firebase in the background.
     """
     try:
         new_state_data['last_update'] = time.time()
-        if convo_id:
-            # Update existing conversation
-            db.collection('conversations').document(convo_id).update(new_state_data)
-            print(f"Updated conversation state for: {convo_id}")
-            return convo_id
-        else:
-            # Create new conversation
-            doc_ref = db.collection('conversations').add(new_state_data)
-            convo_id = doc_ref[1].id
-            print(f"Created new conversation: {convo_id}")
-        return convo_id
+        SESSION_STORE.update(responder_id, new_state_data, start_new)
+        logger.debug(f"Updated conversation state for: {responder_id}")
+        return responder_id
     except Exception as e:
-        print(f"Error updating conversation state: {e}")
+        logger.error(f"Error updating conversation state: {e}")
         return None
 
+def keep_only_voiced(responder_id, voiced_text):
+    """
+    Part of a reply never reached the responder: saves only what they heard,
+    so the next turn gives the rest of the instructions again.
+    """
+    try:
+        SESSION_STORE.amend_last_reply(responder_id, voiced_text)
+        logger.warning(f"Saved only the voiced part of the reply for {responder_id}: {voiced_text}")
+    except Exception as e:
+        logger.error(f"Error trimming the conversation to its voiced reply: {e}")
+
+# --- (NEW) v3.9: BUFFERED TRANSCRIPT LOG WRITER ---
+
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 50)) # Firestore allows up to 500 writes per batch
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 0.5))
+LOG_QUEUE_LIMIT = int(os.environ.get('LOG_QUEUE_LIMIT', 1000))
+LOG_ENQUEUE_TIMEOUT = 0.05
+LOG_MAX_RETRIES = 3
+
+class TranscriptLogWriter:
+    """
+    Queues transcript and event records and writes them to Firestore in batch
+    writes from a background thread, whenever a batch fills up or the flush
+    interval passes. Requests only pay for putting a record on the queue.
+    """
+
+    def __init__(self, collection_name, batch_size, flush_interval, queue_limit, max_retries):
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=queue_limit)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def log(self, record):
+        """
+        Queues a record. If the queue is full we wait briefly (backpressure),
+        then write it inline rather than drop it.
+        """
+        try:
+            self._queue.put(record, timeout=LOG_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            logger.warning("Log queue full. Writing record inline.")
+            self._write_batch([record])
+
+    def close(self, timeout=10):
+        """Stops the writer after everything queued has been written. Called on shutdown."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        else:
+            self._drain()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+        self._drain()
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) == self.batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, records):
+        for attempt in range(self.max_retries + 1):
+            try:
+                batch = db.batch()
+                collection = db.collection(self.collection_name)
+                for record in records:
+                    batch.set(collection.document(), record)
+                with timed("firestore_log_commit"):
+                    batch.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Error writing {len(records)} log records (attempt {attempt + 1}): {e}")
+                if attempt < self.max_retries:
+                    time.sleep(0.2 * 2 ** attempt)
+        logger.error(f"Dropped {len(records)} log records after {self.max_retries + 1} attempts.")
+        return False
+
+TRANSCRIPT_LOG = TranscriptLogWriter('transcripts', LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_QUEUE_LIMIT, LOG_MAX_RETRIES)
+
+# --- (NEW) v3.9: RECENT EVENTS RING BUFFER ---
+
+DEBRIEF_EVENT_TYPES = ('stress_detected', 'manual_log')
+RECENT_EVENTS_PER_TYPE = int(os.environ.get('RECENT_EVENTS_PER_TYPE', 50))
+# 'firestore' (the default) serves summaries and debriefs with typed queries,
+# so every worker sees every worker's events; this worker's own events are
+# merged in from the ring buffer below until the log writer has flushed them.
+# 'memory' serves them from the ring buffer alone, seeded at startup; use it
+# only when a single process does the logging.
+RECENT_EVENTS_SOURCE = os.environ.get('RECENT_EVENTS_SOURCE', 'firestore')
+
+class RecentEvents:
+    """
+    The newest transcript records of each type, kept in memory as they are
+    logged, so "summarize" and "debrief" don't have to scan Firestore.
+    """
+
+    def __init__(self, per_type_limit):
+        self.per_type_limit = per_type_limit
+        self._by_type = {}
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            events = self._by_type.setdefault(record.get('type'), deque(maxlen=self.per_type_limit))
+            events.append(record)
+
+    def latest(self, event_types, limit):
+        """The newest `limit` records of the given types, oldest first."""
+        with self._lock:
+            records = [record for event_type in event_types for record in self._by_type.get(event_type, ())]
+        records.sort(key=lambda record: record.get('timestamp', 0))
+        return records[-limit:]
+
+    def seed(self, event_types):
+        """Fills the buffer from Firestore at startup, one typed query per event type."""
+        for event_type in event_types:
+            docs = db.collection('transcripts') \
+                     .where('type', '==', event_type) \
+                     .order_by('timestamp', direction=DESCENDING) \
+                     .limit(self.per_type_limit) \
+                     .stream()
+            for record in reversed([doc.to_dict() for doc in docs]):
+                self.add(record)
+
+RECENT_EVENTS = RecentEvents(RECENT_EVENTS_PER_TYPE)
+
+def log_event(log_data):
+    """Records a transcript event in the ring buffer and queues it for Firestore."""
+    RECENT_EVENTS.add(log_data)
+    TRANSCRIPT_LOG.log(log_data)
+
+def latest_events(event_types, limit):
+    """
+    The newest events of the given types, oldest first: from a typed Firestore
+    query plus this worker's own events, or from the ring buffer alone when
+    RECENT_EVENTS_SOURCE is 'memory'.
+    """
+    local = RECENT_EVENTS.latest(event_types, limit)
+    if RECENT_EVENTS_SOURCE == 'memory':
+        return local
+    with timed("firestore_query"):
+        docs = db.collection('transcripts') \
+                 .where('type', 'in', list(event_types)) \
+                 .order_by('timestamp', direction=DESCENDING) \
+                 .limit(limit) \
+                 .stream()
+        records = [doc.to_dict() for doc in docs]
+    # Events still queued in the log writer aren't in Firestore yet
+    seen = {(record.get('timestamp'), record.get('type'), record.get('text')) for record in records}
+    records += [record for record in local if (record.get('timestamp'), record.get('type'), record.get('text')) not in seen]
+    records.sort(key=lambda record: record.get('timestamp', 0))
+    return records[-limit:]
+
 # --- (NEW) v3.7: CEREBRAS CONVERSATIONAL AI PROMPT ---
 
+# The system message is the same for every turn of a protocol (rules, then the
+# protocol itself), so the provider can cache it. Everything that changes per
+# turn goes in GUIDANCE_TURN_PROMPT after it.
 GUIDANCE_SYSTEM_PROMPT = """
 You are Virgo, an AI co-pilot for a first responder.
 Your job is to be a calm, clear, and direct conversational guide.
@@ -161,18 +1172,21 @@ CRITICAL RULES:
 2.  **Do Not Repeat:** *Do not repeat* a question if the user has already answered it. If their answer is simple (e.g., 'no,' 'yes,' 'on my leg'), acknowledge it (e.g., 'Okay, on your leg.') and proceed to the *next logical step* in the protocol.
 3.  **Handle Confusion:** If the user's message is confusing or doesn't answer your question (e.g., 'what?', 'huh?', or an unrelated statement), *do not repeat* your last question. Instead, **rephrase it** to be clearer. For example, if you asked "What is your location?" and the user says "what?", you should respond with "I'm sorry, I didn't understand. Can you please confirm your location?"
 
+Based *only* on the context and protocol, what is the *single most important next question or instruction* you should give?
+Respond ONLY with your line of dialogue.
+WHEN THE *ENTIRE* PROTOCOL IS FINISHED, or the user confirms the situation is resolved, you *must* end your response with the special tag: [CONVERSATION_COMPLETE]
+
 ---
-CONTEXT: {context}
 PROTOCOL NAME: {protocol_name}
 PROTOCOL STEPS: {protocol_steps}
+---
+"""
+
+GUIDANCE_TURN_PROMPT = """
+CONTEXT: {context}
 CONVERSATION HISTORY:
 {history}
 USER'S LATEST MESSAGE: "{user_message}"
----
-
-Based *only* on the context and protocol, what is the *single most important next question or instruction* you should give?
-Respond ONLY with your line of dialogue.
-WHEN THE *ENTIRE* PROTOCOL IS FINISHED, or the user confirms the situation is resolved, you *must* end your response with the special tag: [CONVERSATION_COMPLETE]
 """
 
 # --- (NEW) FEATURE 5 PROMPT ---
@@ -194,167 +1208,1274 @@ Be concise.
 Respond ONLY with the summary. Do not add greetings.
 """
 
+# --- (NEW) v3.9: FIXED PHRASES ---
+# Lines Virgo says word-for-word. Their audio is pre-warmed into the TTS cache at startup.
+STRESS_REMINDER = "Deep breath. Focus."
+SIGN_OFF = "Roger that. Virgo out."
+NO_DEBRIEF_EVENTS = "No critical events to debrief."
+NO_RECENT_COMMS = "No recent communications to summarize."
+NOTE_NOT_CAUGHT = "I heard the 'take a note' command, but didn't catch the note. Please try again."
+CONNECTION_TROUBLE = "I'm sorry, I'm having trouble connecting."
+REPLY_CUT_OFF = "Part of my reply didn't come through. Say 'continue' for the rest."
+
+FIXED_PHRASES = [STRESS_REMINDER, SIGN_OFF, NO_DEBRIEF_EVENTS, NO_RECENT_COMMS, NOTE_NOT_CAUGHT, CONNECTION_TROUBLE, REPLY_CUT_OFF]
+
 
 # --- CEREBRAS HELPER FUNCTIONS ---
 
-def handle_conversation_turn(protocol, transcript, convo_doc=None):
+# --- (NEW) v3.9: BOUNDED CONVERSATION HISTORY ---
+
+HISTORY_RECENT_TURNS = int(os.environ.get('HISTORY_RECENT_TURNS', 4))
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', 600))
+SUMMARY_TOKEN_BUDGET = int(os.environ.get('SUMMARY_TOKEN_BUDGET', 300))
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1 # Close enough for English and Llama tokenizers
+
+def _clip(text, limit):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + "..."
+
+class ConversationHistory:
     """
-    This is the new "brain" of our AI. It handles one turn of the conversation.
+    A protocol conversation's memory, kept inside a token budget. The last
+    few turns stay verbatim; older ones are folded into a running compact
+    summary, so a long incident costs no more per turn than a short one.
+    """
+
+    def __init__(self, turns=None, summary_lines=None, omitted=0):
+        self.turns = list(turns or [])                # [{"user": ..., "ai": ...}], oldest first
+        self.summary_lines = list(summary_lines or []) # One compact line per folded turn
+        self.omitted = omitted                        # Folded turns that fell out of the summary too
+
+    @classmethod
+    def from_state(cls, convo_state):
+        history = cls(convo_state.get('turns'), convo_state.get('summary_lines'), convo_state.get('omitted', 0))
+        legacy = convo_state.get('history')
+        if legacy and not history.turns and not history.summary_lines:
+            # Conversations saved before v3.9 kept one long string
+            history.summary_lines = [_clip(legacy, 4 * SUMMARY_TOKEN_BUDGET)]
+        return history
+
+    def to_state(self):
+        return {"turns": self.turns, "summary_lines": self.summary_lines, "omitted": self.omitted}
+
+    def turn_count(self):
+        return len(self.turns) + len(self.summary_lines) + self.omitted
+
+    def add_turn(self, user_message, ai_message):
+        self.turns.append({"user": user_message, "ai": ai_message})
+        self._compact()
+
+    def _compact(self):
+        while len(self.turns) > 1 and (len(self.turns) > HISTORY_RECENT_TURNS or estimate_tokens(self._recent_text()) > HISTORY_TOKEN_BUDGET):
+            oldest = self.turns.pop(0)
+            self.summary_lines.append(f"User: {_clip(oldest['user'], 120)} / You: {_clip(oldest['ai'], 80)}")
+        while len(self.summary_lines) > 1 and estimate_tokens("\n".join(self.summary_lines)) > SUMMARY_TOKEN_BUDGET:
+            self.summary_lines.pop(0)
+            self.omitted += 1
+
+    def _recent_text(self):
+        return "".join(f"USER: {turn['user']}\nAI: {turn['ai']}\n" for turn in self.turns)
+
+    def render(self):
+        if not self.turns and not self.summary_lines:
+            return "AI: [Conversation Started]\n"
+        parts = []
+        if self.summary_lines:
+            parts.append("Earlier in this conversation (summary):")
+            if self.omitted:
+                parts.append(f"- ({self.omitted} earlier exchanges omitted)")
+            parts.extend(f"- {line}" for line in self.summary_lines)
+            parts.append("Most recent exchanges:")
+        return "\n".join(parts) + ("\n" if parts else "") + self._recent_text()
+
+def render_protocol_prompt(protocol):
+    """The stable per-protocol system prompt, precompiled by the protocol registry."""
+    return PROTOCOLS.current.compiled(protocol).system_prompt
+
+def build_guidance_prompt(protocol, transcript, convo_doc=None):
+    """
+    Builds the Cerebras messages for one conversation turn: the stable
+    protocol prefix, then this turn's context. Returns (messages, history).
     """
-    
-    # 1. Build the context for the AI
     if convo_doc:
-        convo_state = convo_doc.to_dict()
-        convo_id = convo_doc.id
+        history = ConversationHistory.from_state(convo_doc.to_dict())
         context = "Continuing an active protocol."
-        history = convo_state.get('history', "")
     else:
-        convo_state = {}
-        convo_id = None
+        history = ConversationHistory()
         context = "A new protocol has just been triggered."
-        history = "AI: [Conversation Started]\n"
-
-    # 2. Create the prompt for Cerebras
-    prompt = GUIDANCE_SYSTEM_PROMPT.format(
-        context=context,
-        protocol_name=protocol.get('name', 'N/A'),
-        protocol_steps=protocol.get('steps', 'N/A'),
-        history=history,
-        user_message=transcript
-    )
+
+    messages = [
+        {"role": "system", "content": render_protocol_prompt(protocol)},
+        {"role": "user", "content": GUIDANCE_TURN_PROMPT.format(
+            context=context,
+            history=history.render(),
+            user_message=transcript
+        )},
+    ]
+    return messages, history
+
+def finish_conversation_turn(protocol, responder_id, start_new, history, transcript, ai_response_text):
+    """
+    Saves the turn to the conversation "memory" and returns the AI's
+    dialogue with the [CONVERSATION_COMPLETE] tag cleaned out.
+    """
+    new_state = {
+        "protocol_id": protocol.get('id'),
+        "protocol_name": protocol.get('name'),
+    }
+
+    # Check if the AI wants to end the conversation
+    if COMPLETE_TAG in ai_response_text:
+        new_state['state'] = 'complete'
+        # Clean the tag out of the response we send to the user
+        ai_response_text = ai_response_text.replace(COMPLETE_TAG, "").strip()
+        logger.info("Conversation state set to 'complete'.")
+    else:
+        new_state['state'] = 'active'
+
+    history.add_turn(transcript, ai_response_text)
+    new_state.update(history.to_state())
+    update_conversation_state(responder_id, new_state, start_new)
+    return ai_response_text
+
+def protocol_steps(protocol):
+    """The protocol's steps, precompiled by the protocol registry."""
+    return PROTOCOLS.current.compiled(protocol).steps
+
+def fallback_conversation_turn(protocol, responder_id, start_new, history, transcript):
+    """
+    Guidance without the LLM: reads out the protocol's next step, one per
+    turn, and saves the turn like any other.
+    """
+    steps = protocol_steps(protocol)
+    if not steps:
+        return CONNECTION_TROUBLE
+    next_step = steps[min(history.turn_count(), len(steps) - 1)]
+    logger.warning(f"Falling back to protocol step for {protocol.get('name')}: {next_step}")
+    return finish_conversation_turn(protocol, responder_id, start_new, history, transcript, next_step)
+
+def handle_conversation_turn(protocol, transcript, convo_doc=None, responder_id=DEFAULT_RESPONDER_ID):
+    """
+    This is the new "brain" of our AI. It handles one turn of the conversation.
+    """
+    
+    # 1. Build the context and prompt for the AI
+    messages, history = build_guidance_prompt(protocol, transcript, convo_doc)
     
-    print(f"Sending to Cerebras (SDK) for CONVERSATION: {transcript}")
+    logger.debug(f"Sending to Cerebras (SDK) for CONVERSATION: {transcript}")
     MODEL_ID = "llama3.1-8b"
     
     try:
-        # 3. Call Cerebras
-        chat_completion = cerebras_client.chat.completions.create(
-            model=MODEL_ID,
-            messages=[{"role": "system", "content": prompt}],
-            temperature=0.3
-        )
+        # 2. Call Cerebras
+        with timed("llm_turn"):
+            chat_completion = CEREBRAS_GUARD.call(lambda: cerebras_client.chat.completions.create(
+                model=MODEL_ID,
+                messages=messages,
+                temperature=0.3,
+                timeout=CEREBRAS_GUARD.timeout
+            ), hedge=True)
         ai_response_text = chat_completion.choices[0].message.content.strip()
-        print(f"Cerebras (SDK) response: {ai_response_text}")
+        logger.debug(f"Cerebras (SDK) response: {ai_response_text}")
 
-        # 4. Update the conversation "memory" in Firebase
-        new_history = f"{history}USER: {transcript}\nAI: {ai_response_text}\n"
+        # 3. Update the conversation "memory" and return the AI's dialogue
+        return finish_conversation_turn(protocol, responder_id, convo_doc is None, history, transcript, ai_response_text)
         
-        new_state = {
-            "protocol_id": protocol.get('id'),
-            "protocol_name": protocol.get('name'),
-            "history": new_history,
-        }
+    except Exception as e:
+        logger.error(f"Exception while calling Cerebras SDK for conversation: {e}")
+        return fallback_conversation_turn(protocol, responder_id, convo_doc is None, history, transcript)
 
-        # Check if the AI wants to end the conversation
-        if "[CONVERSATION_COMPLETE]" in ai_response_text:
-            new_state['state'] = 'complete'
-            # Clean the tag out of the response we send to the user
-            ai_response_text = ai_response_text.replace("[CONVERSATION_COMPLETE]", "").strip()
-            print("Conversation state set to 'complete'.")
-        else:
-            new_state['state'] = 'active'
-        
-        update_conversation_state(convo_id, new_state)
-        
-        # 5. Return the AI's dialogue
-        return ai_response_text
-        
+# --- (NEW) v3.9: PRECOMPUTED PROTOCOL OPENINGS ---
+
+# How many of a protocol's trigger keywords get their own opening line
+OPENING_VARIANTS = int(os.environ.get('OPENING_VARIANTS', 3))
+# Generated lines are kept next to the protocol snapshot, keyed by a hash of each
+# protocol's content, so every worker and every restart serves the same text
+# (and the same cached audio) until the protocol itself changes
+PROTOCOL_OPENINGS_PATH = os.environ.get('PROTOCOL_OPENINGS_PATH', os.path.join(os.path.dirname(PROTOCOL_SNAPSHOT_PATH), "protocol_openings.json"))
+OPENINGS_LOCK_STALE_SECONDS = 60 # A lock this old was left by a worker that died mid-build
+
+def protocol_digest(protocol):
+    return hashlib.sha256(json.dumps(protocol, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def read_saved_openings():
+    """{protocol digest: {normalized keyword: line}} from disk; empty if there is no file yet."""
+    try:
+        with open(PROTOCOL_OPENINGS_PATH) as openings_file:
+            return json.load(openings_file)['openings']
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Error reading saved protocol openings: {e}")
+        return {}
+
+def save_openings(openings):
+    """Writes the openings atomically, like the protocol snapshot."""
+    temp_path = f"{PROTOCOL_OPENINGS_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as openings_file:
+            json.dump({"saved_at": time.time(), "openings": openings}, openings_file)
+        os.replace(temp_path, PROTOCOL_OPENINGS_PATH)
+    except Exception as e:
+        logger.error(f"Error saving protocol openings: {e}")
+
+@contextmanager
+def openings_file_lock():
+    """
+    Held by one worker on this host at a time while it generates lines, so the
+    others wait and then read its lines instead of generating their own.
+    """
+    lock_path = f"{PROTOCOL_OPENINGS_PATH}.lock"
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > OPENINGS_LOCK_STALE_SECONDS:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+def generate_opening_line(protocol, keyword):
+    """
+    Asks the model for a protocol's first line as if `keyword` had just been
+    heard, and voices it into the TTS cache. Returns None if either step fails.
+    """
+    messages, _ = build_guidance_prompt(protocol, keyword)
+    MODEL_ID = "llama3.1-8b"
+    try:
+        chat_completion = cached_completion(MODEL_ID, messages, temperature=0.3)
+    except Exception as e:
+        logger.error(f"Exception while generating the opening line for {protocol.get('name')}: {e}")
+        return None
+    line = chat_completion.choices[0].message.content.strip()
+    if not line or COMPLETE_TAG in line:
+        return None
+    if generate_voice_audio(line) is None:
+        return None
+    return line
+
+class OpeningLines:
+    """
+    The first guidance line of each protocol, one variant per trigger
+    keyword, voiced into the TTS cache whenever protocols load or change.
+    Lines are only generated for protocols whose content has no saved lines
+    yet. The first turn of a new protocol is answered from here; the live
+    model takes over from the second turn.
+    """
+
+    def __init__(self):
+        self._lines = {}     # protocol id -> (protocol, {normalized keyword: line})
+        self._pending = None # Newest version waiting to be built
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def refresh(self, version):
+        """Queues a rebuild for `version`. Versions queued while one is building are coalesced."""
+        with self._lock:
+            self._pending = version
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="virgo-openings", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        READINESS.wait_for(("providers",), timeout=None)
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                version, self._pending = self._pending, None
+            if version is None:
+                continue
+            if not keys_loaded:
+                READINESS.set("openings", "failed")
+                continue
+            try:
+                self._build(version)
+            except Exception as e:
+                logger.error(f"Error precomputing protocol openings: {e}")
+
+    def _build(self, version):
+        started = time.perf_counter()
+        generated = 0
+        digests = {protocol['id']: protocol_digest(protocol) for protocol in version.protocols}
+        openings = read_saved_openings() # Once per build; _generate re-reads under the lock
+        for protocol in version.protocols:
+            known = self._lines.get(protocol['id'])
+            if known and known[0] is protocol:
+                continue # Unchanged since the last build
+            keywords = protocol.get('keywords', [])[:OPENING_VARIANTS]
+            saved = openings.get(digests[protocol['id']], {})
+            if any(normalize_transcript(keyword) not in saved for keyword in keywords):
+                saved, count = self._generate(protocol, keywords, digests)
+                generated += count
+            variants = {}
+            for keyword in keywords:
+                line = saved.get(normalize_transcript(keyword))
+                # Normally a cache hit; re-voiced if the audio was evicted
+                if line and generate_voice_audio(line) is not None:
+                    variants[normalize_transcript(keyword)] = line
+            # Publish each protocol as soon as it is ready, replacing the dict so readers never see it change
+            lines = dict(self._lines)
+            if variants:
+                lines[protocol['id']] = (protocol, variants)
+            else:
+                lines.pop(protocol['id'], None)
+            self._lines = lines
+        self._lines = {protocol_id: entry for protocol_id, entry in self._lines.items() if protocol_id in version.by_id}
+        READINESS.set("openings", "ready")
+        if generated:
+            logger.info(f"Precomputed {generated} protocol opening lines in {time.perf_counter() - started:.2f}s.")
+
+    def _generate(self, protocol, keywords, digests):
+        """
+        Generates the lines this protocol's content doesn't have saved yet, and
+        saves them. Another worker may have done it while we waited for the lock.
+        """
+        digest = digests[protocol['id']]
+        with openings_file_lock():
+            openings = read_saved_openings()
+            saved = dict(openings.get(digest, {}))
+            count = 0
+            for keyword in keywords:
+                if normalize_transcript(keyword) in saved:
+                    continue
+                line = generate_opening_line(protocol, keyword)
+                if line:
+                    saved[normalize_transcript(keyword)] = line
+                    count += 1
+            if count:
+                # Lines for edits that are no longer current are dropped
+                current = set(digests.values())
+                openings = {key: lines for key, lines in openings.items() if key in current}
+                openings[digest] = saved
+                save_openings(openings)
+        return saved, count
+
+    def lookup(self, protocol, clean_text):
+        """The opening for the keyword that triggered `protocol`, else its first variant."""
+        entry = self._lines.get(protocol.get('id'))
+        if entry is None or entry[0] is not protocol:
+            return None # Not built yet, or built for an older edit of this protocol
+        variants = entry[1]
+        for match in find_protocol_triggers(clean_text):
+            keyword = normalize_transcript(match['keyword'])
+            if match['protocol'] is protocol and keyword in variants:
+                return variants[keyword]
+        return next(iter(variants.values()))
+
+OPENING_LINES = OpeningLines()
+
+def opening_turn(protocol, transcript, responder_id):
+    """
+    Starts a newly triggered protocol with its precomputed opening line and
+    saves it as the first turn. Returns None when there isn't one.
+    """
+    line = OPENING_LINES.lookup(protocol, normalize_transcript(transcript))
+    if line is None:
+        return None
+    logger.info(f"Serving the precomputed opening for {protocol.get('name')}: {line}")
+    return finish_conversation_turn(protocol, responder_id, True, ConversationHistory(), transcript, line)
+
+# --- (NEW) v3.9: SENTENCE-PIPELINED CONVERSATION TURNS ---
+
+COMPLETE_TAG = "[CONVERSATION_COMPLETE]"
+
+# Stream protocol guidance from the LLM and start speaking each sentence while
+# the next one is still being generated. Needs streamed audio to be on.
+PIPELINE_GUIDANCE = os.environ.get('PIPELINE_GUIDANCE', 'true').lower() not in ('0', 'false', 'no')
+
+SENTENCE_END = re.compile(r'[.!?]+["\')\]]*\s+')
+
+class SentenceSplitter:
+    """
+    Cuts a stream of LLM tokens into whole sentences for TTS.
+    The [CONVERSATION_COMPLETE] tag is stripped as it streams past, even when
+    it arrives split across several tokens; `complete` records that it was seen.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self.complete = False
+
+    def feed(self, token):
+        """Adds a token and returns any sentences it finished."""
+        self._buffer += token
+        if COMPLETE_TAG in self._buffer:
+            self._buffer = self._buffer.replace(COMPLETE_TAG, " ")
+            self.complete = True
+
+        # Never cut inside what might still turn into the tag
+        held_back = ""
+        tag_start = self._buffer.rfind("[")
+        if tag_start != -1 and COMPLETE_TAG.startswith(self._buffer[tag_start:]):
+            self._buffer, held_back = self._buffer[:tag_start], self._buffer[tag_start:]
+
+        sentences = []
+        cut = 0
+        for boundary in SENTENCE_END.finditer(self._buffer):
+            sentence = " ".join(self._buffer[cut:boundary.end()].split())
+            if sentence:
+                sentences.append(sentence)
+            cut = boundary.end()
+        self._buffer = self._buffer[cut:] + held_back
+        return sentences
+
+    def flush(self):
+        """Returns whatever is left once the stream has ended."""
+        remainder = " ".join(self._buffer.split())
+        self._buffer = ""
+        return [remainder] if remainder else []
+
+def stream_conversation_turn(protocol, transcript, convo_doc=None, responder_id=DEFAULT_RESPONDER_ID):
+    """
+    Generator version of handle_conversation_turn. Streams the Cerebras reply
+    and yields it one sentence at a time; the conversation state is saved once
+    the whole reply has been generated.
+    """
+    messages, history = build_guidance_prompt(protocol, transcript, convo_doc)
+    
+    logger.debug(f"Streaming from Cerebras (SDK) for CONVERSATION: {transcript}")
+    MODEL_ID = "llama3.1-8b"
+    splitter = SentenceSplitter()
+    spoken = []
+    started = time.perf_counter()
+    
+    def open_stream():
+        # Opening the stream and its first chunk is what the deadline and hedging cover
+        chunks = iter(cerebras_client.chat.completions.create(
+            model=MODEL_ID,
+            messages=messages,
+            temperature=0.3,
+            stream=True,
+            timeout=CEREBRAS_GUARD.timeout
+        ))
+        return chunks, next(chunks, None)
+    
+    try:
+        token_stream, first_chunk = CEREBRAS_GUARD.call(open_stream, hedge=True)
+        for chunk in itertools.chain([first_chunk] if first_chunk else [], token_stream):
+            if not chunk.choices:
+                continue
+            for sentence in splitter.feed(chunk.choices[0].delta.content or ""):
+                if not spoken:
+                    record_stage("llm_first_sentence", time.perf_counter() - started)
+                spoken.append(sentence)
+                yield sentence
+        for sentence in splitter.flush():
+            if not spoken:
+                record_stage("llm_first_sentence", time.perf_counter() - started)
+            spoken.append(sentence)
+            yield sentence
+        record_stage("llm_stream", time.perf_counter() - started)
     except Exception as e:
-        print(f"Exception while calling Cerebras SDK for conversation: {e}")
-        return "I'm sorry, I'm having trouble connecting."
+        logger.error(f"Exception while streaming Cerebras SDK for conversation: {e}")
+        if not spoken:
+            yield fallback_conversation_turn(protocol, responder_id, convo_doc is None, history, transcript)
+            return
+
+    ai_response_text = " ".join(spoken)
+    logger.debug(f"Cerebras (SDK) streamed response: {ai_response_text}")
+    if splitter.complete:
+        ai_response_text += f" {COMPLETE_TAG}"
+    finish_conversation_turn(protocol, responder_id, convo_doc is None, history, transcript, ai_response_text)
 
 def summarize_text(text_to_summarize, prompt_template):
     """
     A generic function to call Cerebras for summarization or debriefing.
+    Returns None if the call failed or ran out of time.
     """
-    print(f"Sending to Cerebras (SDK) for SUMMARY/DEBRIEF: {text_to_summarize[:50]}...")
+    logger.debug(f"Sending to Cerebras (SDK) for SUMMARY/DEBRIEF: {text_to_summarize[:50]}...")
     MODEL_ID = "llama3.1-8b" 
     try:
-        chat_completion = cerebras_client.chat.completions.create(
-            model=MODEL_ID,
-            messages=[
+        with timed("llm_summary"):
+            chat_completion = cached_completion(MODEL_ID, [
                 {"role": "system", "content": prompt_template},
                 {"role": "user", "content": text_to_summarize} # Send the logs as the user message
-            ],
-            temperature=0.3 
-        )
+            ], temperature=0.3)
         summary = chat_completion.choices[0].message.content.strip()
-        print(f"Cerebras (SDK) summary/debrief complete: {summary}")
+        logger.debug(f"Cerebras (SDK) summary/debrief complete: {summary}")
         return summary
     except Exception as e:
-        print(f"Exception while calling Cerebras SDK for summary: {e}")
-        return f"Error during summary: {e}"
+        logger.error(f"Exception while calling Cerebras SDK for summary: {e}")
+        return None
+
+# --- (NEW) v3.9: ROLLING SUMMARIES ---
+
+FOLD_SUMMARY_PROMPT = """
+You are an AI assistant for a first responder.
+You will be given a PREVIOUS SUMMARY and some NEW EVENTS that happened after it.
+Update the summary so it also covers the new events, keeping it just as brief.
+Respond ONLY with the updated summary. Do not add greetings.
+"""
+
+def describe_comm(event):
+    return event.get('text', '')
+
+def describe_critical_event(event):
+    if event.get('type') == 'stress_detected':
+        return f"Stress detected: {event.get('text', '')}"
+    return f"Manual log: {event.get('text', '')}"
+
+class RollingSummary:
+    """
+    Caches a summary under the timestamp of the newest event it covers.
+    Asking again with nothing new logged returns the cached text; when new
+    events arrive, only those are folded into the previous summary.
+    """
+
+    def __init__(self, prompt_template, describe_event):
+        self.prompt_template = prompt_template
+        self.describe_event = describe_event
+        self.newest_timestamp = None
+        self.summary = None
+        self._lock = threading.Lock()
+
+    def plan(self, events):
+        """
+        Decides what a summary of `events` (oldest first) needs.
+        Returns (cached_summary, None, None) when nothing changed, otherwise
+        (None, text_to_summarize, prompt_template) for the LLM.
+        """
+        with self._lock:
+            previous_timestamp, previous_summary = self.newest_timestamp, self.summary
+        if previous_summary is not None and previous_timestamp == events[-1].get('timestamp', 0):
+            logger.debug("Nothing new since the last summary. Serving it from cache.")
+            return previous_summary, None, None
+
+        new_events = [e for e in events if previous_timestamp is not None and e.get('timestamp', 0) > previous_timestamp]
+        if previous_summary is not None and 0 < len(new_events) < len(events):
+            logger.debug(f"Folding {len(new_events)} new events into the previous summary.")
+            new_lines = "\n".join(f"- {self.describe_event(e)}" for e in new_events)
+            return None, f"PREVIOUS SUMMARY:\n{previous_summary}\n\nNEW EVENTS:\n{new_lines}", FOLD_SUMMARY_PROMPT
+        return None, "\n- ".join(self.describe_event(e) for e in events), self.prompt_template
+
+    def record(self, events, summary):
+        """Remembers a fresh summary of `events`."""
+        newest_timestamp = events[-1].get('timestamp', 0)
+        with self._lock:
+            if self.newest_timestamp is None or newest_timestamp >= self.newest_timestamp:
+                self.newest_timestamp, self.summary = newest_timestamp, summary
+
+    def summarize(self, events):
+        """`events` are the window to summarize, oldest first."""
+        cached_summary, text_to_summarize, prompt_template = self.plan(events)
+        if cached_summary is not None:
+            return cached_summary
+        summary = summarize_text(text_to_summarize, prompt_template)
+        if summary is None:
+            return self.fallback(events)
+        self.record(events, summary)
+        return summary
+
+    def fallback(self, events):
+        """
+        Text-only stand-in when the LLM is unavailable: the last summary we
+        have, plus the newest events read out as they were logged.
+        """
+        with self._lock:
+            previous_timestamp, previous_summary = self.newest_timestamp, self.summary
+        if previous_summary is not None:
+            newer = [e for e in events if e.get('timestamp', 0) > previous_timestamp]
+        else:
+            newer = events
+        parts = [previous_summary] if previous_summary else []
+        if newer:
+            parts.append("Latest: " + "; ".join(self.describe_event(e) for e in newer[-3:]))
+        return " ".join(parts)
+
+COMMS_SUMMARY = RollingSummary(SUMMARY_SYSTEM_PROMPT, describe_comm)
+DEBRIEF_SUMMARY = RollingSummary(DEBRIEF_SYSTEM_PROMPT, describe_critical_event)
 
 
 # --- ELEVENLABS & SIMPLE STRESS CHECK FUNCTIONS ---
 
+VOICE_ID = "JBFqnCBsd6RMkjVDRZzb"
+VOICE_MODEL_ID = "eleven_multilingual_v2"
+VOICE_OUTPUT_FORMAT = "mp3_44100_128"
+
+# --- (NEW) v3.9: TTS AUDIO CACHE ---
+
+TTS_CACHE_DIR = os.environ.get('TTS_CACHE_DIR', os.path.join(project_dir, "tts_cache"))
+TTS_CACHE_MEMORY_BYTES = int(os.environ.get('TTS_CACHE_MEMORY_BYTES', 16 * 1024 * 1024))
+TTS_CACHE_DISK_BYTES = int(os.environ.get('TTS_CACHE_DISK_BYTES', 256 * 1024 * 1024))
+
+class AudioCache:
+    """
+    Content-addressed cache for synthesized speech. A small in-memory LRU sits
+    in front of an on-disk store; both tiers are evicted by total size.
+    """
+
+    def __init__(self, cache_dir, memory_limit, disk_limit):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict() # key -> audio bytes, oldest first
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith('.mp3'))
+        except OSError as e:
+            logger.warning(f"Error opening TTS cache directory, disk tier disabled: {e}")
+            self.disk_limit = 0
+            self._disk_bytes = 0
+
+    @staticmethod
+    def make_key(text, voice_id, model_id, output_format):
+        payload = json.dumps([text, voice_id, model_id, output_format])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+
+    def get(self, key):
+        with self._lock:
+            audio_bytes = self._memory.get(key)
+            if audio_bytes is not None:
+                self._memory.move_to_end(key)
+                return audio_bytes
+        if not self.disk_limit:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                audio_bytes = f.read()
+            os.utime(self._path(key)) # Mark as recently used for disk eviction
+        except OSError:
+            return None
+        self._remember(key, audio_bytes)
+        return audio_bytes
+
+    def put(self, key, audio_bytes):
+        if not audio_bytes:
+            return
+        self._remember(key, audio_bytes)
+        if not self.disk_limit:
+            return
+        try:
+            # Write then rename, so a reader never sees a half-written file
+            temp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(audio_bytes)
+            existed = os.path.exists(self._path(key))
+            os.replace(temp_path, self._path(key))
+            with self._lock:
+                if not existed:
+                    self._disk_bytes += len(audio_bytes)
+                over_limit = self._disk_bytes > self.disk_limit
+            if over_limit:
+                self._evict_disk()
+        except OSError as e:
+            logger.error(f"Error writing TTS cache entry: {e}")
+
+    def _remember(self, key, audio_bytes):
+        if len(audio_bytes) > self.memory_limit:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = audio_bytes
+            self._memory_bytes += len(audio_bytes)
+            while self._memory_bytes > self.memory_limit:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        """Deletes least-recently-used files until the disk tier is back under its limit."""
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.mp3')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.disk_limit:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+TTS_CACHE = AudioCache(TTS_CACHE_DIR, TTS_CACHE_MEMORY_BYTES, TTS_CACHE_DISK_BYTES)
+
+def voice_cache_key(text_to_speak):
+    return AudioCache.make_key(text_to_speak, VOICE_ID, VOICE_MODEL_ID, VOICE_OUTPUT_FORMAT)
+
+def warm_voice_cache():
+    """
+    Synthesizes any FIXED_PHRASES that aren't cached yet. Runs in the background at startup.
+    """
+    for phrase in FIXED_PHRASES:
+        if TTS_CACHE.get(voice_cache_key(phrase)) is None:
+            generate_voice_audio(phrase)
+    logger.info("TTS cache warm-up complete.")
+
+# Per-request timeout inside the SDK, so calls abandoned by the deadline still end
+ELEVENLABS_REQUEST_OPTIONS = {"timeout_in_seconds": math.ceil(ELEVENLABS_GUARD.timeout)}
+ELEVENLABS_CLIP_REQUEST_OPTIONS = {"timeout_in_seconds": math.ceil(ELEVENLABS_CLIP_GUARD.timeout)}
+
 def generate_voice_audio(text_to_speak):
-    print(f"Sending to ElevenLabs for voice generation: {text_to_speak}")
+    cache_key = voice_cache_key(text_to_speak)
+    cached_audio = TTS_CACHE.get(cache_key)
+    if cached_audio is not None:
+        logger.debug(f"Serving cached voice audio: {text_to_speak}")
+        return cached_audio
+
+    logger.debug(f"Sending to ElevenLabs for voice generation: {text_to_speak}")
     try:
-        audio_stream = elevenlabs_client.text_to_speech.convert(
-            text=text_to_speak,
-            voice_id="JBFqnCBsd6RMkjVDRZzb",
-            model_id="eleven_multilingual_v2",
-            output_format="mp3_44100_128"
-        )
-        audio_bytes = b"".join(chunk for chunk in audio_stream)
-        print("ElevenLabs audio generated and assembled successfully.")
+        with timed("tts"):
+            audio_bytes = ELEVENLABS_CLIP_GUARD.call(lambda: b"".join(elevenlabs_client.text_to_speech.convert(
+                text=text_to_speak,
+                voice_id=VOICE_ID,
+                model_id=VOICE_MODEL_ID,
+                output_format=VOICE_OUTPUT_FORMAT,
+                request_options=ELEVENLABS_CLIP_REQUEST_OPTIONS
+            )), hedge=True)
+        logger.debug("ElevenLabs audio generated and assembled successfully.")
+        TTS_CACHE.put(cache_key, audio_bytes)
         return audio_bytes
     except Exception as e:
-        print(f"Error calling ElevenLabs: {e}")
+        logger.error(f"Error calling ElevenLabs: {e}")
         return None
 
+# --- (NEW) v3.9: STREAMED VOICE RESPONSES ---
+
+# Stream audio chunks to the client as ElevenLabs produces them (chunked transfer),
+# instead of buffering the whole MP3. A request can override with ?stream=0 / ?stream=1.
+STREAM_AUDIO = os.environ.get('STREAM_AUDIO', 'true').lower() not in ('0', 'false', 'no')
+
+def stream_voice_audio(text_to_speak):
+    """
+    Like generate_voice_audio, but returns an iterator of MP3 chunks.
+    The first chunk is pulled before returning, so a failed ElevenLabs call
+    still returns None (and a 500) instead of an empty 200 response.
+    Fully streamed clips are added to the TTS cache.
+    """
+    cache_key = voice_cache_key(text_to_speak)
+    cached_audio = TTS_CACHE.get(cache_key)
+    if cached_audio is not None:
+        logger.debug(f"Serving cached voice audio: {text_to_speak}")
+        return iter([cached_audio])
+
+    logger.debug(f"Streaming from ElevenLabs for voice generation: {text_to_speak}")
+    def open_stream():
+        chunks = iter(elevenlabs_client.text_to_speech.stream(
+            text=text_to_speak,
+            voice_id=VOICE_ID,
+            model_id=VOICE_MODEL_ID,
+            output_format=VOICE_OUTPUT_FORMAT,
+            request_options=ELEVENLABS_REQUEST_OPTIONS
+        ))
+        return chunks, next(chunks)
+
+    try:
+        with timed("tts_first_chunk"):
+            audio_stream, first_chunk = ELEVENLABS_GUARD.call(open_stream, hedge=True)
+    except Exception as e:
+        logger.error(f"Error calling ElevenLabs: {e}")
+        return None
+
+    def chunks():
+        received = [first_chunk]
+        yield first_chunk
+        try:
+            for chunk in audio_stream:
+                received.append(chunk)
+                yield chunk
+        except Exception as e:
+            # Headers are already sent, all we can do is end the stream early
+            logger.error(f"Error while streaming ElevenLabs audio: {e}")
+            return
+        logger.debug("ElevenLabs audio streamed successfully.")
+        TTS_CACHE.put(cache_key, b"".join(received))
+    return chunks()
+
+def wants_streamed_audio():
+    stream_arg = request.args.get('stream')
+    if stream_arg is None:
+        return STREAM_AUDIO
+    return stream_arg.lower() not in ('0', 'false', 'no')
+
+def text_only_response(text_to_speak):
+    """
+    The reply without audio, when ElevenLabs is down or out of time. Still a
+    200: the client shows the text (and can speak it with its own voice).
+    """
+    logger.warning(f"Sending text-only reply: {text_to_speak}")
+    return jsonify({"text": text_to_speak, "fallback": "text_only"})
+
+def voice_response(text_to_speak):
+    """
+    Turns a line of dialogue into our audio/mpeg response, streamed or buffered.
+    """
+    if wants_streamed_audio():
+        audio_chunks = stream_voice_audio(text_to_speak)
+        if audio_chunks:
+            return Response(audio_chunks, mimetype="audio/mpeg")
+    else:
+        audio_data = generate_voice_audio(text_to_speak)
+        if audio_data:
+            return Response(audio_data, mimetype="audio/mpeg")
+    return text_only_response(text_to_speak)
+
+def voice_body_sentence(sentence):
+    """
+    Audio for a sentence after the first: streamed, or as a whole clip through
+    its own guard when streaming failed. None if neither worked.
+    """
+    sentence_audio = stream_voice_audio(sentence)
+    if sentence_audio:
+        return sentence_audio
+    clip = generate_voice_audio(sentence)
+    return iter([clip]) if clip else None
+
+def pipelined_voice_response(sentences, responder_id=DEFAULT_RESPONDER_ID):
+    """
+    Speaks each sentence as soon as it is ready. A worker thread keeps pulling
+    sentences from the LLM while we stream out the audio of the earlier ones.
+    Once the audio has started, each sentence gets the TTS timeout of its own
+    rather than what is left of the request's budget.
+    """
+    sentence_queue = queue.Queue()
+    timings = CURRENT_TIMINGS.get()
+
+    def produce():
+        try:
+            for sentence in sentences:
+                sentence_queue.put(sentence)
+        except Exception as e:
+            logger.error(f"Error while generating sentences: {e}")
+        finally:
+            sentence_queue.put(None) # End of the reply
+
+    # Run in a copy of this request's context so the LLM spans are still attributed to it
+    threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+
+    first_sentence = sentence_queue.get()
+    first_audio = stream_voice_audio(first_sentence) if first_sentence else None
+    if not first_audio:
+        # No voice: wait for the rest of the reply and send it as text
+        sentences = []
+        if first_sentence:
+            sentences = [first_sentence] + list(iter(sentence_queue.get, None))
+        return text_only_response(" ".join(sentences) or CONNECTION_TROUBLE)
+
+    def audio_chunks():
+        if timings is not None:
+            timings.in_body = True
+        yield from first_audio
+        voiced = [first_sentence]
+        for sentence in iter(sentence_queue.get, None):
+            sentence_audio = voice_body_sentence(sentence)
+            if not sentence_audio:
+                break
+            yield from sentence_audio
+            voiced.append(sentence)
+        else:
+            return
+        # An audio body can't carry the rest as text. Never drop an instruction
+        # silently: say that the reply was cut off, and remember only what was
+        # heard (the sentinel comes after the turn is saved, so this wins).
+        unvoiced = [sentence] + list(iter(sentence_queue.get, None))
+        logger.error(f"Could not voice the rest of the reply: {' '.join(unvoiced)}")
+        keep_only_voiced(responder_id, " ".join(voiced))
+        notice = generate_voice_audio(REPLY_CUT_OFF)
+        if notice:
+            yield notice
+    return Response(audio_chunks(), mimetype="audio/mpeg")
+
+def conversation_turn_response(protocol, transcript, convo_doc=None, responder_id=DEFAULT_RESPONDER_ID):
+    """
+    Runs one protocol turn and returns the audio response, pipelining the
+    LLM and TTS sentence by sentence when we are streaming audio.
+    """
+    if convo_doc is None:
+        opening = opening_turn(protocol, transcript, responder_id)
+        if opening:
+            set_branch("protocol_opening")
+            return voice_response(opening)
+    if PIPELINE_GUIDANCE and wants_streamed_audio():
+        return pipelined_voice_response(stream_conversation_turn(protocol, transcript, convo_doc, responder_id), responder_id)
+    ai_response_text = handle_conversation_turn(protocol, transcript, convo_doc, responder_id)
+    logger.info(f"CONVERSATIONAL RESPONSE: {ai_response_text}")
+    return voice_response(ai_response_text)
+
 STRESS_SYSTEM_PROMPT = """
 You are an AI analysis tool... Respond ONLY with a valid JSON object...
 {"is_stressed": true, "reason": "High urgency and panic detected in tone."}
 OR
 {"is_stressed": false, "reason": "Calm and procedural."}
 """
-def analyze_for_stress_simple(text_to_analyze):
-    print(f"Sending to Cerebras (SDK) for SIMPLE STRESS analysis: {text_to_analyze}")
+
+# --- (NEW) v3.9: LOCAL FIRST-PASS STRESS SCORER ---
+# Routine traffic ("10-4, en route") is decided locally, but only on positive
+# calm evidence: a transcript with no cue either way ("he's got a knife") is
+# sent to Cerebras, as is anything between the two thresholds.
+
+URGENT_CUES = {
+    "help": 2.0, "hurry": 1.5, "emergency": 2.0, "mayday": 3.0, "backup": 1.5,
+    "need backup": 1.5, "send help": 2.0, "shots": 2.0, "gun": 2.0, "bleeding": 2.0,
+    "hurt": 1.5, "injured": 1.5, "ambulance": 1.0, "fire": 1.0, "down": 0.5,
+    "oh god": 2.0, "oh my god": 2.0, "please": 1.0, "now": 0.5, "cant breathe": 3.0,
+    "get down": 2.0, "run": 1.0, "10-33": 3.0, "10-78": 2.0, "knife": 2.0,
+    "weapon": 2.0, "needs assistance": 2.0,
+}
+CALM_CUES = {
+    "copy": 1.5, "copy that": 1.0, "10-4": 2.0, "roger": 1.5, "en route": 1.5,
+    "affirmative": 1.5, "negative": 0.5, "standing by": 1.5, "all clear": 2.0,
+    "code 4": 2.0, "10-8": 1.5, "10-7": 1.5, "checking in": 1.5, "routine": 1.5,
+}
+STRESS_CALM_THRESHOLD = -1.0    # At or below, with a calm cue and no urgent cue: calm
+STRESS_STRESSED_THRESHOLD = 3.0 # At or above: stressed
+
+def _cue_hits(clean_text, cues):
+    # Whole-word/phrase hits only, using the same normalization as the transcript
+    padded = f" {clean_text} "
+    return [cue for cue in cues if f" {normalize_transcript(cue)} " in padded]
+
+def stress_cue_score(text_to_analyze, clean_text):
+    """Scores a transcript from lexical urgency cues, punctuation and repetition. Returns (score, urgent cues, calm cues)."""
+    words = clean_text.split()
+    urgent = _cue_hits(clean_text, URGENT_CUES)
+    calm = _cue_hits(clean_text, CALM_CUES)
+    score = sum(URGENT_CUES[cue] for cue in urgent) - sum(CALM_CUES[cue] for cue in calm)
+    score += min(text_to_analyze.count("!"), 3) * 0.75
+    # "Help, help!" / "go go go": back-to-back repeated words read as panic
+    score += sum(1.0 for previous, word in zip(words, words[1:]) if previous == word)
+    shouted = [word for word in text_to_analyze.split() if len(word) > 2 and word.isupper()]
+    score += min(len(shouted), 3) * 0.5
+    return score, urgent, calm
+
+def score_stress_locally(text_to_analyze, clean_text=None):
+    """
+    Returns the usual {"is_stressed", "reason"} dict with tier "local" when
+    the cue score is confident either way, or None when the model should decide.
+    """
+    clean_text = clean_text if clean_text is not None else normalize_transcript(text_to_analyze)
+    if not clean_text.split():
+        return None
+
+    score, urgent, calm = stress_cue_score(text_to_analyze, clean_text)
+    if score >= STRESS_STRESSED_THRESHOLD:
+        return {"is_stressed": True, "reason": f"Urgency cues: {', '.join(urgent) or 'tone'}.", "tier": "local", "score": score}
+    # No cue at all is no evidence of calm: let the model judge it
+    if calm and not urgent and score <= STRESS_CALM_THRESHOLD:
+        return {"is_stressed": False, "reason": "Calm and procedural.", "tier": "local", "score": score}
+    return None
+
+def parse_stress_reply(content):
+    """Pulls the JSON object out of the model's reply, even if it wrapped it in prose."""
+    match = re.search(r'\{.*\}', content or "", re.DOTALL)
+    if not match:
+        raise ValueError(f"No JSON object in reply: {content!r}")
+    analysis_json = json.loads(match.group(0))
+    analysis_json['is_stressed'] = bool(analysis_json.get('is_stressed'))
+    return analysis_json
+
+def analyze_for_stress_simple(text_to_analyze, clean_text=None):
+    with timed("stress_local"):
+        local_result = score_stress_locally(text_to_analyze, clean_text)
+    if local_result:
+        logger.debug(f"Local stress check decided: {local_result}")
+        return local_result
+
+    logger.debug(f"Sending to Cerebras (SDK) for SIMPLE STRESS analysis: {text_to_analyze}")
     MODEL_ID = "llama3.1-8b" 
     try:
-        chat_completion = cerebras_client.chat.completions.create(
-            model=MODEL_ID,
-            messages=[
+        with timed("llm_stress"):
+            chat_completion = cached_completion(MODEL_ID, [
                 {"role": "system", "content": STRESS_SYSTEM_PROMPT},
                 {"role": "user", "content": text_to_analyze}
-            ],
-            temperature=0.1
-        )
+            ], temperature=0.1)
         content = chat_completion.choices[0].message.content
-        analysis_json = json.loads(content)
+        analysis_json = parse_stress_reply(content)
+        analysis_json['tier'] = "llm"
         return analysis_json
     except Exception as e:
-        return {"error": f"Exception calling SDK: {e}"}
+        return fallback_stress_check(text_to_analyze, clean_text, e)
+
+def fallback_stress_check(text_to_analyze, clean_text, error):
+    """When the model can't decide in time, the local score decides: above the midpoint counts as stressed."""
+    clean_text = clean_text if clean_text is not None else normalize_transcript(text_to_analyze)
+    score, urgent, _ = stress_cue_score(text_to_analyze, clean_text)
+    is_stressed = score >= (STRESS_CALM_THRESHOLD + STRESS_STRESSED_THRESHOLD) / 2
+    reason = f"Urgency cues: {', '.join(urgent)}." if is_stressed and urgent else "Model unavailable; decided from cues."
+    return {"is_stressed": is_stressed, "reason": reason, "tier": "fallback", "score": score, "error": str(error)}
+
+# --- (NEW) v3.9: IN-MEMORY AUDIO INGESTION & SILENCE TRIMMING ---
+# Uploads stay in memory (never written to disk). PCM WAV clips have leading and
+# trailing silence trimmed, and all-silent clips are rejected before any upstream
+# call. Compressed formats (webm/opus, mp3) can't be inspected without a decoder,
+# so they pass through unchanged; the demo page decodes its recordings and
+# uploads 16-bit WAV for this reason.
+
+VAD_FRAME_MS = 20
+VAD_PEAK_THRESHOLD = int(os.environ.get('VAD_PEAK_THRESHOLD', 1000)) # Of 32767, about -30 dBFS
+VAD_MIN_VOICED_FRAMES = 3  # A lone click from the push-to-talk button isn't speech
+VAD_PADDING_MS = 200       # Keep a little audio either side of the speech
+
+def pcm16_samples(pcm_bytes):
+    samples = array('h')
+    samples.frombytes(pcm_bytes[:len(pcm_bytes) - len(pcm_bytes) % 2])
+    if sys.byteorder == 'big':
+        samples.byteswap() # PCM16 is little-endian on the wire
+    return samples
+
+def pcm16_frame_is_voiced(pcm_bytes):
+    samples = pcm16_samples(pcm_bytes)
+    return bool(samples) and max(max(samples), -min(samples)) >= VAD_PEAK_THRESHOLD
+
+def find_speech_bounds(pcm_bytes, sample_rate, channels):
+    """
+    Returns (start, end) byte offsets of the speech in 16-bit PCM, padded by
+    VAD_PADDING_MS, or None if the audio is all silence.
+    """
+    frame_bytes = max(2 * channels * sample_rate * VAD_FRAME_MS // 1000, 2 * channels)
+    voiced = [pcm16_frame_is_voiced(pcm_bytes[offset:offset + frame_bytes])
+              for offset in range(0, len(pcm_bytes), frame_bytes)]
+
+    # Speech starts/ends at the first/last run of VAD_MIN_VOICED_FRAMES voiced frames
+    runs = [i for i in range(len(voiced) - VAD_MIN_VOICED_FRAMES + 1) if all(voiced[i:i + VAD_MIN_VOICED_FRAMES])]
+    if not runs:
+        return None
+    padding = VAD_PADDING_MS // VAD_FRAME_MS
+    first_frame = max(runs[0] - padding, 0)
+    last_frame = min(runs[-1] + VAD_MIN_VOICED_FRAMES + padding, len(voiced))
+    return first_frame * frame_bytes, min(last_frame * frame_bytes, len(pcm_bytes))
+
+def prepare_audio(audio_bytes):
+    """
+    Returns (audio_bytes, has_speech). WAV clips come back trimmed; other
+    formats come back unchanged and are assumed to contain speech.
+    """
+    if audio_bytes[:4] != b'RIFF' or audio_bytes[8:12] != b'WAVE':
+        return audio_bytes, True
+    try:
+        with wave.open(io.BytesIO(audio_bytes), 'rb') as clip:
+            params = clip.getparams()
+            if params.sampwidth != 2:
+                return audio_bytes, True
+            pcm_bytes = clip.readframes(params.nframes)
+    except (wave.Error, EOFError) as e:
+        logger.warning(f"Could not parse WAV upload, sending it as-is: {e}")
+        return audio_bytes, True
+
+    bounds = find_speech_bounds(pcm_bytes, params.framerate, params.nchannels)
+    if bounds is None:
+        return b"", False
+    start, end = bounds
+    if start == 0 and end == len(pcm_bytes):
+        return audio_bytes, True
+
+    trimmed = io.BytesIO()
+    with wave.open(trimmed, 'wb') as clip:
+        clip.setnchannels(params.nchannels)
+        clip.setsampwidth(params.sampwidth)
+        clip.setframerate(params.framerate)
+        clip.writeframes(pcm_bytes[start:end])
+    logger.debug(f"Trimmed silence: {len(pcm_bytes)} -> {end - start} bytes of audio.")
+    return trimmed.getvalue(), True
+
+def read_upload(audio_file):
+    """
+    Reads an uploaded file into memory. Returns None if it is over MAX_UPLOAD_BYTES
+    (in case the client sent no Content-Length for Flask to check).
+    """
+    audio_bytes = audio_file.read(MAX_UPLOAD_BYTES + 1)
+    return audio_bytes if len(audio_bytes) <= MAX_UPLOAD_BYTES else None
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"Audio file is larger than {MAX_UPLOAD_BYTES} bytes"}), 413
+
+# --- (NEW) v3.9: BACKGROUND STARTUP & READINESS ---
+
+# How long a request that arrives during startup waits for the providers it needs
+STARTUP_WAIT_SECONDS = float(os.environ.get('STARTUP_WAIT_SECONDS', 10))
+
+class Readiness:
+    """
+    The startup state of each dependency: "starting", then "ready" or "failed".
+    Protocols are "snapshot" while served from disk, "live" once loaded from Firebase.
+    """
+
+    READY_STATES = ("ready", "snapshot", "live")
+
+    def __init__(self, names):
+        self._states = {name: "starting" for name in names}
+        self._settled = {name: threading.Event() for name in names}
+
+    def set(self, name, state):
+        self._states[name] = state
+        if state != "starting":
+            self._settled[name].set()
+
+    def settled(self, names):
+        return all(self._settled[name].is_set() for name in names)
+
+    def wait_for(self, names, timeout):
+        """Blocks until every dependency in `names` is ready or has failed. False on timeout."""
+        if timeout is None:
+            return all(self._settled[name].wait() for name in names)
+        deadline = time.time() + timeout
+        return all(self._settled[name].wait(max(0, deadline - time.time())) for name in names)
+
+    def is_ready(self, names):
+        return all(self._states[name] in self.READY_STATES for name in names)
+
+    def report(self):
+        return dict(self._states)
+
+# voice_cache and openings are informational: a cold cache is slower, not broken
+READINESS = Readiness(("firebase", "providers", "protocols", "sessions", "voice_cache", "openings"))
+ROUTER_DEPENDENCIES = ("firebase", "providers", "protocols", "sessions")
+
+def recover_sessions():
+    """
+    Recovers active conversations, retrying with backoff until it works: until
+    then, every responder without a session costs a Firestore read.
+    """
+    delay = 1
+    while True:
+        try:
+            SESSION_STORE.recover()
+            return
+        except Exception as e:
+            logger.error(f"Error recovering active conversations (retrying in {delay}s): {e}")
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+
+def start_up():
+    """
+    Everything that used to run at import: provider clients, the live protocol
+    library, active conversations and the voice cache. Runs in a background
+    thread while requests are already served from the protocol snapshot.
+    """
+    started = time.perf_counter()
+    init_provider_clients()
+    READINESS.set("providers", "ready" if keys_loaded else "failed")
+    init_firebase()
+    READINESS.set("firebase", "ready" if firebase_connected else "failed")
+
+    # Sessions are usable as soon as Firebase is: until recovery finishes, a
+    # responder's conversation is read from Firestore on first use. Then the
+    # live protocols (already served from the snapshot), recovery and seeding.
+    if firebase_connected:
+        SESSION_STORE.start()
+        atexit.register(SESSION_STORE.flush)
+        TRANSCRIPT_LOG.start()
+        atexit.register(TRANSCRIPT_LOG.close)
+        READINESS.set("sessions", "ready")
+        load_protocols_from_firebase()
+        if PROTOCOL_WATCH:
+            try:
+                PROTOCOLS.watch(db.collection('protocols'))
+                atexit.register(PROTOCOLS.stop)
+            except Exception as e:
+                logger.error(f"Error watching protocols (use /reload-protocols instead): {e}")
+        threading.Thread(target=recover_sessions, name="virgo-recover", daemon=True).start()
+        if RECENT_EVENTS_SOURCE == 'memory':
+            try:
+                RECENT_EVENTS.seed(('general_comm',) + DEBRIEF_EVENT_TYPES)
+            except Exception as e:
+                logger.error(f"Error seeding recent events: {e}")
+    else:
+        logger.critical("Firebase not connected. Protocols will not be loaded.")
+        READINESS.set("sessions", "failed")
+    if READINESS.report()["protocols"] == "starting":
+        READINESS.set("protocols", "failed")
+    logger.info(f"Startup finished in {time.perf_counter() - started:.2f}s.")
+
+    # Pre-warm the audio for our fixed phrases
+    if keys_loaded:
+        warm_voice_cache()
+        READINESS.set("voice_cache", "ready")
+    else:
+        READINESS.set("voice_cache", "failed")
+
+# Serve protocols from the last snapshot right away, then start everything else
+if load_protocol_snapshot():
+    READINESS.set("protocols", "snapshot")
+threading.Thread(target=start_up, name="virgo-startup", daemon=True).start()
+
+def wait_for_startup():
+    """Holds a request that arrived during startup until its dependencies settle."""
+    if READINESS.settled(ROUTER_DEPENDENCIES):
+        return True
+    with timed("startup_wait"):
+        settled = READINESS.wait_for(ROUTER_DEPENDENCIES, STARTUP_WAIT_SECONDS)
+    restart_budget() # The request's deadline starts now, not while it was held
+    return settled
+
 
 # --- MAIN API ENDPOINT (The "Router") ---
 
-# Load the protocols when the server first starts
-if firebase_connected:
-    load_protocols_from_firebase()
-else:
-    print("CRITICAL: Firebase not connected. Protocols will not be loaded.")
 
+@app.before_request
+def start_request_timing():
+    CURRENT_TIMINGS.set(RequestTimings())
+
+@app.after_request
+def add_server_timing(response):
+    timings = CURRENT_TIMINGS.get()
+    if timings is None:
+        return response
+    response.headers['Server-Timing'] = timings.server_timing()
+    response.headers['X-Virgo-Branch'] = timings.branch
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # Streamed bodies are still being sent here, so the request is timed when the response closes
+    response.call_on_close(lambda: finish_request_timing(timings, route, response.status_code))
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Latency histograms in the Prometheus text format."""
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route('/')
 def home():
     return f"""Virgo's Whisper AI (v3.8) is online.
-    {len(PROTOCOL_LIBRARY)} protocols loaded.
+    {len(PROTOCOLS.current.protocols)} protocols loaded (version {PROTOCOLS.current.number}).
     <form action="/reload-protocols" method="post">
         <button type="submit">Reload Protocols from Firebase</button>
     </form>
     """
 
+@app.route('/ready')
+def ready():
+    """Readiness probe: 200 once every dependency the router needs is warm, 503 until then."""
+    report = READINESS.report()
+    status = 200 if READINESS.is_ready(ROUTER_DEPENDENCIES) else 503
+    return jsonify({"ready": status == 200, "dependencies": report,
+                    "protocol_version": PROTOCOLS.current.number}), status
+
 @app.route('/reload-protocols', methods=['POST'])
 def reload_protocols():
     """Endpoint to manually reload protocols without restarting the server."""
     load_protocols_from_firebase()
-    return f"Reloaded. {len(PROTOCOL_LIBRARY)} protocols now loaded."
+    return f"Reloaded. {len(PROTOCOLS.current.protocols)} protocols now loaded (version {PROTOCOLS.current.number})."
 
 @app.route('/analyze-audio-file', methods=['POST'])
 def analyze_audio_file():
-    print("Received a request on /analyze-audio-file...")
+    logger.info("Received a request on /analyze-audio-file...")
+    if not wait_for_startup():
+        return jsonify({"error": "Server is still starting up"}), 503
     if 'audio_file' not in request.files:
         return jsonify({"error": "No 'audio_file' key in request"}), 400
     
@@ -362,57 +2483,69 @@ def analyze_audio_file():
     if audio_file.filename == '':
         return jsonify({"error": "No file selected"}), 400
 
-    # 1. Save and 2. Transcribe
-    temp_file_path = os.path.join(project_dir, audio_file.filename)
+    # Also accepted in the query string, where a proxy can route on it (see ConversationSessionStore)
+    responder_id = request.form.get('responder_id') or request.args.get('responder_id') or DEFAULT_RESPONDER_ID
+    if not RESPONDER_ID_PATTERN.match(responder_id):
+        return jsonify({"error": "Invalid 'responder_id'"}), 400
+
+    # 1. Read into memory and trim silence
+    audio_bytes = read_upload(audio_file)
+    if audio_bytes is None:
+        return jsonify({"error": f"Audio file is larger than {MAX_UPLOAD_BYTES} bytes"}), 413
+    with timed("vad"):
+        audio_bytes, has_speech = prepare_audio(audio_bytes)
+    if not has_speech:
+        set_branch("no_speech")
+        return jsonify({"error": "No speech detected"}), 422
+
+    # 2. Transcribe (straight from memory)
     transcript_text = ""
     try:
-        audio_file.save(temp_file_path)
-        transcriber = aai.Transcriber()
-        transcript = transcriber.transcribe(temp_file_path)
-        if transcript.status == aai.TranscriptStatus.error:
+        with timed("transcribe"):
+            transcript = transcriber.transcribe(io.BytesIO(audio_bytes))
+        if transcript.status == "error": # aai.TranscriptStatus.error
             return jsonify({"error": f"AssemblyAI Error: {transcript.error}"}), 500
         transcript_text = transcript.text
         if not transcript_text:
             return jsonify({"error": "Transcription returned no text"}), 500
     except Exception as e:
         return jsonify({"error": f"Server error: {e}"}), 500
-    finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
 
     # 3. CONVERSATION ROUTING
     try:
         ai_response_text = None
         
         # Define clean_text here for all checks
-        clean_text = transcript_text.lower().translate(str.maketrans('', '', string.punctuation))
+        clean_text = normalize_transcript(transcript_text)
 
         # Check for "over and out" first as a master override
         if "over and out" in clean_text:
-            print("'Over and out' detected. Ending conversation.")
-            active_convo_doc = get_active_conversation()
+            logger.info("'Over and out' detected. Ending conversation.")
+            set_branch("sign_off")
+            active_convo_doc = get_active_conversation(responder_id)
             if active_convo_doc:
-                update_conversation_state(active_convo_doc.id, {"state": "complete"})
+                update_conversation_state(responder_id, {"state": "complete"})
             
-            audio_data = generate_voice_audio("Roger that. Virgo out.")
-            return Response(audio_data, mimetype="audio/mpeg")
+            return voice_response(SIGN_OFF)
 
         # Check for an active conversation
-        active_convo_doc = get_active_conversation()
+        active_convo_doc = get_active_conversation(responder_id)
         
         if active_convo_doc:
             convo_state = active_convo_doc.to_dict()
-            protocol = next((p for p in PROTOCOL_LIBRARY if p['id'] == convo_state.get('protocol_id')), None)
+            protocol = find_protocol(convo_state.get('protocol_id'))
             if protocol:
-                ai_response_text = handle_conversation_turn(protocol, transcript_text, active_convo_doc)
+                set_branch("protocol_turn")
+                return conversation_turn_response(protocol, transcript_text, active_convo_doc, responder_id)
             else:
-                print(f"Error: Active convo {active_convo_doc.id} has a missing protocol ID. Treating as new.")
+                logger.warning(f"Active convo for {responder_id} has a missing protocol ID. Treating as new.")
         
         if not ai_response_text:
             # No active convo. Check for our non-protocol commands.
             
             if "virgo take a note" in clean_text:
-                print("Command detected: 'virgo take a note'")
+                logger.info("Command detected: 'virgo take a note'")
+                set_branch("note")
                 try:
                     note = transcript_text.lower().split("take a note", 1)[1].strip()
                 except IndexError:
@@ -420,84 +2553,62 @@ def analyze_audio_file():
                 
                 if note:
                     log_data = { 'text': note, 'original_command': transcript_text, 'timestamp': time.time(), 'type': 'manual_log' }
-                    db.collection('transcripts').add(log_data)
-                    print(f"Successfully logged manual note: {note}")
+                    log_event(log_data)
+                    logger.info(f"Successfully logged manual note: {note}")
                     ai_response_text = f"Note taken: {note}"
                 else:
-                    ai_response_text = "I heard the 'take a note' command, but didn't catch the note. Please try again."
+                    ai_response_text = NOTE_NOT_CAUGHT
 
             elif "virgo summarize" in clean_text:
-                print("Command detected: 'virgo summarize'")
-                docs_stream = db.collection('transcripts').where('type', '==', 'general_comm').order_by('timestamp', direction=firestore.Query.DESCENDING).limit(10).stream()
-                recent_comms = [doc.to_dict().get('text', '') for doc in docs_stream]
-                recent_comms.reverse()
+                logger.info("Command detected: 'virgo summarize'")
+                set_branch("summarize")
+                recent_comms = latest_events(['general_comm'], 10)
                 
                 if not recent_comms:
-                    ai_response_text = "No recent communications to summarize."
+                    ai_response_text = NO_RECENT_COMMS
                 else:
-                    comms_for_prompt = "\n- ".join(recent_comms)
-                    ai_response_text = summarize_text(comms_for_prompt, SUMMARY_SYSTEM_PROMPT)
+                    ai_response_text = COMMS_SUMMARY.summarize(recent_comms)
             
             # --- (THIS IS THE FIX) ---
             # Changed 'clean_' to 'clean_text' and added the missing ':'
             elif "virgo debrief me" in clean_text:
-                print("Command detected: 'virgo debrief me'")
-                docs_stream = db.collection('transcripts') \
-                                .order_by('timestamp', direction=firestore.Query.DESCENDING) \
-                                .limit(20) \
-                                .stream()
-                
-                critical_events = []
-                for doc in docs_stream:
-                    event = doc.to_dict()
-                    event_type = event.get('type')
-                    if event_type == 'stress_detected':
-                        critical_events.append(f"Stress detected: {event.get('text', '')}")
-                    elif event_type == 'manual_log':
-                        critical_events.append(f"Manual log: {event.get('text', '')}")
-                
-                critical_events.reverse() # Put in chronological order
+                logger.info("Command detected: 'virgo debrief me'")
+                set_branch("debrief")
+                critical_events = latest_events(DEBRIEF_EVENT_TYPES, 20)
 
                 if not critical_events:
-                    ai_response_text = "No critical events to debrief."
+                    ai_response_text = NO_DEBRIEF_EVENTS
                 else:
-                    events_for_prompt = "\n- ".join(critical_events)
-                    ai_response_text = summarize_text(events_for_prompt, DEBRIEF_SYSTEM_PROMPT)
+                    ai_response_text = DEBRIEF_SUMMARY.summarize(critical_events)
             # --- (END OF FIX) ---
             
             # Check for a *new* protocol trigger.
             if not ai_response_text:
-                triggered_protocol = check_for_protocol_trigger(transcript_text)
+                triggered_protocol = check_for_protocol_trigger(clean_text)
                 if triggered_protocol:
-                    ai_response_text = handle_conversation_turn(triggered_protocol, transcript_text, None)
+                    set_branch("protocol_turn")
+                    return conversation_turn_response(triggered_protocol, transcript_text, None, responder_id)
         
         if ai_response_text:
             # We have a conversational response! Generate audio and return it.
-            print(f"CONVERSATIONAL RESPONSE: {ai_response_text}")
-            audio_data = generate_voice_audio(ai_response_text)
-            if audio_data:
-                return Response(audio_data, mimetype="audio/mpeg")
-            else:
-                return jsonify({"error": "Failed to generate voice"}), 500
+            logger.info(f"CONVERSATIONAL RESPONSE: {ai_response_text}")
+            return voice_response(ai_response_text)
         
         # Step 3c: No convo, no trigger. Do a simple stress check (v2.0 logic).
-        print("No conversation or trigger. Running simple stress check.")
-        analysis_result = analyze_for_stress_simple(transcript_text)
+        logger.info("No conversation or trigger. Running simple stress check.")
+        set_branch("stress_only")
+        analysis_result = analyze_for_stress_simple(transcript_text, clean_text)
         
         log_data = { 'text': transcript_text, 'original_filename': audio_file.filename, 'timestamp': time.time(), 'type': 'general_comm', 'cerebras_analysis': analysis_result }
         
         if analysis_result.get("is_stressed") == True:
             log_data['type'] = 'stress_detected'
-            db.collection('transcripts').add(log_data) # Log the stress event
-            audio_data = generate_voice_audio("Deep breath. Focus.")
-            if audio_data:
-                return Response(audio_data, mimetype="audio/mpeg")
-            else:
-                return jsonify({"error": "Failed to generate voice"}), 500
+            log_event(log_data) # Log the stress event
+            return voice_response(STRESS_REMINDER)
         else:
-            db.collection('transcripts').add(log_data) # Log the general_comm event
+            log_event(log_data) # Log the general_comm event
             return "OK", 204 # 204 means "No Content"
 
     except Exception as e:
-        print(f"Error in main analysis loop: {e}")
+        logger.exception(f"Error in main analysis loop: {e}")
         return jsonify({"error": f"Server error: {e}"}), 500
\ No newline at end of file